@@ -52,6 +52,8 @@ PS1_LIST="${SCRIPTS_DIR}/tmp/ps1.list"
 PS1_JPN_LIST="${SCRIPTS_DIR}/tmp/ps1-jpn.list"
 PS2_LIST="${SCRIPTS_DIR}/tmp/ps2.list"
 PS2_JPN_LIST="${SCRIPTS_DIR}/tmp/ps2-jpn.list"
+PS1_CACHE="${SCRIPTS_DIR}/ps1.cache"
+PS2_CACHE="${SCRIPTS_DIR}/ps2.cache"
 TMP_LIST="${SCRIPTS_DIR}/tmp/tmp.list"
 ALL_GAMES="${SCRIPTS_DIR}/tmp/master.list"
 ELF_LIST="${SCRIPTS_DIR}/tmp/elf.list"
@@ -900,19 +902,18 @@ convert_zso() {
     if find "${search_dirs[@]}" -type f -iname "*.zso" | grep -q .; then
         error_msg "Warning" "Games in the compressed ZSO format have been found." "Neutrino does not support compressed ZSO files." " " "ZSO files will be converted to ISO files before proceeding."
 
-        # Convert ZSO to ISO
-        while IFS= read -r -d '' zso_file; do
-            iso_file="${zso_file%.*}.iso"
-            echo "Converting: $zso_file -> $iso_file" | tee -a "${LOG_FILE}"
-
-            python3 -u "${HELPER_DIR}/ziso.py" -c 0 "$zso_file" "$iso_file" | tee -a "${LOG_FILE}"
-            if [ "${PIPESTATUS[0]}" -ne 0 ]; then
-                rm -f "$iso_file"
-                error_msg "Error" "Failed to uncompress $zso_file"
-            fi
+        # Convert every ZSO to ISO on one shared worker pool, -r picks up
+        # where an interrupted conversion left off and -x removes each ZSO
+        # once its ISO is complete
+        zso_dirs=()
+        for dir in "${search_dirs[@]}"; do
+            [[ -d "$dir" ]] && zso_dirs+=("$dir")
+        done
 
-            rm -f "$zso_file"
-        done < <(find "${search_dirs[@]}" -type f -iname "*.zso" -print0)
+        python3 -u "${HELPER_DIR}/ziso.py" batch -B pipe -r -x "${zso_dirs[@]}" | tee -a "${LOG_FILE}"
+        if [ "${PIPESTATUS[0]}" -ne 0 ]; then
+            error_msg "Error" "Failed to uncompress ZSO files. See ${LOG_FILE}"
+        fi
     fi
 }
 
@@ -1802,7 +1803,7 @@ fi
 if find "${STORAGE_DIR}/__.POPS/" -maxdepth 1 -type f \( -iname "*.vcd" \) | grep -q .; then
     echo | tee -a "${LOG_FILE}"
     echo "Creating PS1 games list..." | tee -a "${LOG_FILE}"
-    python3 -u "${HELPER_DIR}/list-builder.py" "${STORAGE_DIR}" "${PS1_LIST}" | tee -a "${LOG_FILE}"
+    python3 -u "${HELPER_DIR}/list-builder.py" -C "${PS1_CACHE}" "${STORAGE_DIR}" "${PS1_LIST}" | tee -a "${LOG_FILE}"
     if [ "${PIPESTATUS[0]}" -ne 0 ]; then
         error_msg "Error" "Failed to create PS1 games list."
     fi
@@ -1871,7 +1872,7 @@ fi
 if find "${OPL}/CD" "${OPL}/DVD" -maxdepth 1 -type f \( -iname "*.iso" -o -iname "*.zso" \) | grep -q .; then
     echo | tee -a "${LOG_FILE}"
     echo "Creating PS2 games list..." | tee -a "${LOG_FILE}"
-    python3 -u "${HELPER_DIR}/list-builder.py" "${OPL}" "${PS2_LIST}" | tee -a "${LOG_FILE}"
+    python3 -u "${HELPER_DIR}/list-builder.py" -C "${PS2_CACHE}" "${OPL}" "${PS2_LIST}" | tee -a "${LOG_FILE}"
     if [ "${PIPESTATUS[0]}" -ne 0 ]; then
         error_msg "Error" "Failed to create PS2 games list."
     fi
@@ -23,11 +23,11 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import sys
-import csv
 import urllib.request
 from urllib.parse import urlparse
 from pathlib import Path
 from html.parser import HTMLParser
+from titlesdb import TitlesDB
 
 CSV_FILE_PATH = './scripts/helper/ArtDB.csv'
 OUTPUT_DIR = './icons/art/tmp'
@@ -52,16 +52,15 @@ SEARCH_DOMAINS = [
 
 
 def find_url_for_game_id(game_id: str) -> str | None:
-    """Search CSV for the given game ID and return full IGN URL."""
+    """Look up the given game ID in ArtDB and return full IGN URL."""
     try:
-        with open(CSV_FILE_PATH, newline="", encoding="utf-8") as csvfile:
-            reader = csv.reader(csvfile, delimiter="|")
-            for row in reader:
-                if len(row) >= 2 and row[0] == game_id:
-                    return f"https://www.ign.com/games/{row[1]}"
+        with TitlesDB(CSV_FILE_PATH) as db:
+            row = db.get(game_id)
     except FileNotFoundError:
         print(f"CSV file not found: {CSV_FILE_PATH}")
         sys.exit(1)
+    if row and len(row) >= 2:
+        return f"https://www.ign.com/games/{row[1]}"
     return None
 
 
@@ -26,81 +26,97 @@ import sys
 import os.path
 import math
 import re
-import lz4.block
-from struct import unpack
+import json
+from getopt import gnu_getopt, GetoptError
+from multiprocessing import Pool
+from ziso import ZsoReader
+from titlesdb import TitlesDB
 
 done = "Error: No games found."
 total = 0
 count = 0
+jobs = os.cpu_count() or 1  # worker processes extracting Game IDs, -j
+cache_path = None  # scan cache, -C, defaults to the list path + ".cache"
+titles = None  # TitlesDB index, opened on the first lookup
+update = False  # --update, only probe images added, renamed or changed since the existing list
+changes_path = None  # --changes, JSON change set against the existing list
 
-ZISO_MAGIC = 0x4F53495A
-SECTOR_SIZE = 2048
-
-pattern_1 = [b'\x01', b'\x0D']
-pattern_2 = [b'\x3B', b'\x31']
-
-# Function to count game files in the given folder
-def count_files(folder, extensions):
-    global total
-    for image in os.listdir(game_path + folder):
-        if image.startswith('.'):
-            continue
-        if any(image.lower().endswith(ext) for ext in extensions):
-            total += 1
-
-def read_zso_header(fin):
-    data = fin.read(24)
-    magic, header_size, total_bytes, block_size, ver, align = unpack('IIQIbbxx', data)
-    return magic, header_size, total_bytes, block_size, ver, align
-
-def lz4_decompress(compressed, block_size):
-    while True:
-        try:
-            return lz4.block.decompress(compressed, uncompressed_size=block_size)
-        except lz4.block.LZ4BlockError:
-            compressed = compressed[:-1]
-
-def build_index(fin, total_bytes, block_size, align):
-    total_blocks = total_bytes // block_size
-    index_buf = [unpack('I', fin.read(4))[0] for _ in range(total_blocks + 1)]
-    return index_buf, total_blocks
-
-def decompress_zso_sector(fin, index_buf, block_size, align, sector, num_sectors=1):
-    # Decompress one or more 2048-byte ISO9660 sectors from a ZSO file efficiently.
-    start_byte = sector * SECTOR_SIZE
-    end_byte = (sector + num_sectors) * SECTOR_SIZE
-    decompressed = bytearray()
+LIST_FIELDS = ["title", "game_id", "publisher", "folder", "file", "jpn_title"]
 
-    # Determine which blocks intersect the requested byte range
-    total_blocks = len(index_buf) - 1
-    block_start_num = start_byte // block_size
-    block_end_num = (end_byte + block_size - 1) // block_size
+# Scan cache: relative image path -> [size, mtime_ns, inode, Game ID, method].
+# Images whose size, mtime and inode still match are not opened again.
+CACHE_VERSION = 1
+cache = {}  # entries from the last run
+new_cache = {}  # entries for the images seen in this run
 
-    for block in range(block_start_num, min(block_end_num, total_blocks)):
-        index = index_buf[block]
-        plain = index & 0x80000000
-        index &= 0x7FFFFFFF
-        read_pos = index << align
-
-        next_index = index_buf[block + 1] & 0x7FFFFFFF
-        read_size = (next_index - index) << align
-
-        fin.seek(read_pos)
-        data = fin.read(read_size)
-        dec_data = data if plain else lz4_decompress(data, block_size)
-
-        block_start_byte = block * block_size
-        block_end_byte = block_start_byte + len(dec_data)
-
-        # Only extract the overlapping part
-        start = max(start_byte - block_start_byte, 0)
-        end = min(end_byte - block_start_byte, len(dec_data))
-        decompressed.extend(dec_data[start:end])
+SECTOR_SIZE = 2048
 
-    return decompressed
+# Fallback scan for a directory record naming the boot file, e.g.
+# \x01\x0DSLUS_123.45;1, read in chunks so whole images are never in memory
+GAME_ID_PATTERN = re.compile(rb'\x01\x0D(.{4})[_-](.{3})\.(.{2});1', re.DOTALL)
+GAME_ID_SKIP = "CDDA_END.DA"
+SCAN_CHUNK = 16 * 1024 * 1024
+
+def load_cache(path):
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+        return {}
+    return data.get("images", {})
+
+def save_cache(path, images):
+    # Written to a temporary file first, an interrupted run keeps the old cache
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({"version": CACHE_VERSION, "images": images}, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not write scan cache {path}: {e}")
+
+# Function to list game files in the given folder with one scandir pass
+def scan_files(folder, extensions):
+    images = []
+    for entry in os.scandir(game_path + folder):
+        image = entry.name
+        if image.startswith('.'):
+            continue  # skip hidden files
+        if not any(image.lower().endswith(ext) for ext in extensions):
+            continue  # skip files that are not in the extension list
+        st = entry.stat()
+        key = os.path.relpath(entry.path, game_path)
+        images.append((folder, image, key, [st.st_size, st.st_mtime_ns, st.st_ino]))
+    return images
+
+def list_folder(folder):
+    # Folder name as written to the list, /__.POPS -> POPS
+    return re.sub(r'^/(?:__\.)?', '', folder)
+
+def list_key(line):
+    # Folder and file name identify an entry of the games list
+    fields = line.split('|')
+    return f"{fields[3]}/{fields[4]}" if len(fields) >= 5 else line
+
+def read_list(path):
+    with open(path, 'r') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+def write_list(path, lines):
+    # Written to a temporary file and renamed, readers never see half a list
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as output:
+        for line in lines:
+            output.write(f"{line}\n")
+    os.replace(tmp_path, path)
+
+def entry_fields(line):
+    return dict(zip(LIST_FIELDS, line.split('|')))
 
 def read_iso_sector(fin, sector, num_sectors=1):
-    # Read one or more raw 2048-byte ISO9660 sectors from an ISO file.
+    # Read one or more raw 2048-byte ISO9660 sectors from an ISO file (or a ZsoReader).
     fin.seek(sector * SECTOR_SIZE)
     return fin.read(num_sectors * SECTOR_SIZE)
 
@@ -149,156 +165,145 @@ def extract_game_id_from_disc(fin, sector_reader):
                     return line.split("\\")[-1].split(";")[0].upper()
     return None
 
-# Function to process game files in the given folder
-def process_files(folder, extensions):
+def scan_game_id(fin):
+    # Fallback: find the first boot file name in the raw image. Each chunk
+    # keeps the last bytes of the one before, so a match spanning two chunks
+    # is still found, while a match can never lie entirely in the overlap.
+    overlap = 14  # one byte short of a full match
+    tail = b""
+    while True:
+        chunk = fin.read(SCAN_CHUNK)
+        if not chunk:
+            return ""
+        data = tail + chunk
+        for match in GAME_ID_PATTERN.finditer(data):
+            string = b"%s_%s.%s" % match.groups()
+            string = string.decode("latin-1")
+            if string != GAME_ID_SKIP:
+                return string
+        tail = data[-overlap:]
+
+def extract_game_id(file_path):
+    # Game ID of one image, run on the worker pool. Messages are returned
+    # with the ID instead of printed, so they come out in list order.
+    image = os.path.basename(file_path)
+    log = []
+    string = ""
+    method = "filename"
+
+    # Extract Game ID from filename if it meets the condition
+    file_name_without_ext = os.path.splitext(image)[0]
+    if len(file_name_without_ext) >= 11 and file_name_without_ext[4] == '_' and file_name_without_ext[8] == '.':
+        string = file_name_without_ext[:11].upper()
+        log.append(f"Filename meets condition. Game ID set directly from filename: {string}")
+
+    # ISO
+    if image.lower().endswith('.iso') and not string:
+        with open(file_path, "rb") as fin:
+            def iso_reader(sector, num_sectors=1):
+                return read_iso_sector(fin, sector, num_sectors)
+            string = extract_game_id_from_disc(fin, iso_reader) or ""
+        method = "iso9660"
+
+    # ZSO
+    if image.lower().endswith('.zso') and not string:
+        try:
+            fin = ZsoReader(file_path)
+        except ValueError:
+            log.append(f"Skipping invalid ZSO: {image}")
+        else:
+            with fin:
+                def zso_reader(sector, num_sectors=1):
+                    return read_iso_sector(fin, sector, num_sectors)
+                string = extract_game_id_from_disc(fin, zso_reader) or ""
+            method = "zso"
+
+    # VCD
+    if image.lower().endswith('.vcd') and not string:
+        method = "vcd"
+        with open(file_path, "rb") as file:
+            for raw_line in file:
+                line = raw_line.strip()
+                line_lower = line.lower()
+                if b'cdrom:' in line_lower and b'boot' in line_lower:
+
+                    idx = line_lower.find(b'cdrom:') + len(b'cdrom:')
+                    segment = line[idx:].split(b';', 1)[0]
+
+                    raw_bytes = segment.split(b'\\')[-1]
+                    string = raw_bytes.decode('utf-8', errors='ignore').upper()
+
+                    if len(string) == 11:
+                        # If it starts with SLUSP, remove the trailing 'P'
+                        if string.startswith("SLUSP"):
+                            string = "SLUS" + string[5:]
+                            
+                        # Only fix if underscore or dot are in the wrong positions
+                        if string[4] != '_' or string[8] != '.':
+                            # Remove any existing underscore or dot
+                            cleaned = string.replace('_', '').replace('.', '').replace('-', '')
+                            # Rebuild with underscore at index 4 and dot at index 8
+                            string = cleaned[:4] + '_' + cleaned[4:7] + '.' + cleaned[7:]
+                    break
+    
+    # Fallback for ISO and VCD
+    if (len(string) < 11 or len(string) > 12) and (image.lower().endswith('.iso') or image.lower().endswith('.vcd')):
+        with open(file_path, "rb") as f:
+            string = scan_game_id(f)
+        method = "scan"
+
+    # If no Game ID is found, generate one from filename
+    if not string:
+        method = "generated"
+        # Remove spaces from filename and convert to uppercase
+        base_name = os.path.splitext(image)[0]  # Strip the file extension
+        string = re.sub(r'[^A-Z0-9]', '', base_name.upper())  # Keep only A-Z and 0-9
+
+        # Trim the string to 9 characters or pad with zeros
+        string = string[:9].ljust(9, '0')
+
+        # Insert the underscore at position 5 and the full stop at position 9
+        string = string[:4] + '_' + string[4:7] + '.' + string[7:]
+
+        # Ensure the string is exactly 11 characters long
+        string = string[:11]
+
+        log.append(f'No Game ID found. Generating Game ID based on filename: {string}')
+
+    return string.upper(), method, log
+
+# Function to process the given game files, returns their list entries
+def process_files(images):
     global total, count, done
 
-    game_names = {}
-    if os.path.isfile(gameid_file_path):
-        with open(gameid_file_path, 'r') as gameid_file:
-            for line in gameid_file:
-                parts = line.strip().split('|')  # Split title ID and game name
-                if len(parts) == 4:
-                    game_names[parts[0]] = (parts[1], parts[2], parts[3])
-
     # Prepare a list to hold all game list entries
     game_list_entries = []
 
-    for image in os.listdir(game_path + folder):
-        if image.startswith('.'):
-            continue  # skip hidden files
-        if not any(image.lower().endswith(ext) for ext in extensions):
-            continue  # skip files that are not in the extension list
+    # Only new or changed images are probed, on a pool sized for them when
+    # there is more than one, results come back in directory order. Pool
+    # workers are daemons, an error here still takes them down on exit.
+    paths = [os.path.join(game_path + folder, image) for folder, image, key, stamp in images
+             if cache.get(key, [])[:3] != stamp]
+    pool = Pool(min(jobs, len(paths))) if jobs > 1 and len(paths) > 1 else None
+    results = pool.imap(extract_game_id, paths) if pool else map(extract_game_id, paths)
+
+    for folder, image, key, stamp in images:
+        cached = cache.get(key)
+        if cached and cached[:3] == stamp:
+            string, method = cached[3:]
+            log = [f"Unchanged since last scan. Game ID from cache ({method}): {string}"]
+        else:
+            string, method, log = next(results)
+        new_cache[key] = stamp + [string, method]
+
         print('Processing', image)
-        string = ""
+        for line in log:
+            print(line)
         original_image = image
 
-        file_path = os.path.join(game_path + folder, image)
-
-        # Extract Game ID from filename if it meets the condition
-        file_name_without_ext = os.path.splitext(image)[0]
-        if len(file_name_without_ext) >= 11 and file_name_without_ext[4] == '_' and file_name_without_ext[8] == '.':
-            string = file_name_without_ext[:11].upper()
-            print(f"Filename meets condition. Game ID set directly from filename: {string}")
-
-        # ISO
-        if image.lower().endswith('.iso') and not string:
-            with open(file_path, "rb") as fin:
-                def iso_reader(sector, num_sectors=1):
-                    return read_iso_sector(fin, sector, num_sectors)
-                string = extract_game_id_from_disc(fin, iso_reader) or ""
-
-        # ZSO
-        if image.lower().endswith('.zso') and not string:
-            with open(file_path, "rb") as fin:
-                magic, header_size, total_bytes, block_size, ver, align = read_zso_header(fin)
-                if magic != ZISO_MAGIC:
-                    print(f"Skipping invalid ZSO: {image}")
-                else:
-                    total_blocks = total_bytes // block_size
-                    index_buf = [unpack('I', fin.read(4))[0] for _ in range(total_blocks + 1)]
-
-                    def zso_reader(sector, num_sectors=1):
-                        return decompress_zso_sector(fin, index_buf, block_size, align, sector, num_sectors)
-
-                    string = extract_game_id_from_disc(fin, zso_reader) or ""
-
-        # VCD
-        if image.lower().endswith('.vcd') and not string:
-            with open(game_path + folder + "/" + image, "rb") as file:
-                for raw_line in file:
-                    line = raw_line.strip()
-                    line_lower = line.lower()
-                    if b'cdrom:' in line_lower and b'boot' in line_lower:
-
-                        idx = line_lower.find(b'cdrom:') + len(b'cdrom:')
-                        segment = line[idx:].split(b';', 1)[0]
-
-                        raw_bytes = segment.split(b'\\')[-1]
-                        string = raw_bytes.decode('utf-8', errors='ignore').upper()
-
-                        if len(string) == 11:
-                            # If it starts with SLUSP, remove the trailing 'P'
-                            if string.startswith("SLUSP"):
-                                string = "SLUS" + string[5:]
-                                
-                            # Only fix if underscore or dot are in the wrong positions
-                            if string[4] != '_' or string[8] != '.':
-                                # Remove any existing underscore or dot
-                                cleaned = string.replace('_', '').replace('.', '').replace('-', '')
-                                # Rebuild with underscore at index 4 and dot at index 8
-                                string = cleaned[:4] + '_' + cleaned[4:7] + '.' + cleaned[7:]
-                        break
-        
-        # Fallback for ISO and VCD
-        if (len(string) < 11 or len(string) > 12) and (image.lower().endswith('.iso') or image.lower().endswith('.vcd')):
-            with open(file_path, "rb") as f:
-                data_to_scan = f.read()  # Scan the entire file
-
-            index = 0
-            string = ""
-            for byte in data_to_scan:
-                if len(string) < 4:
-                    if index == 2:
-                        string += chr(byte)
-                    elif byte == pattern_1[index][0]:
-                        index += 1
-                    else:
-                        string = ""
-                        index = 0
-                elif len(string) == 4:
-                    index = 0
-                    if byte in (0x5F, 0x2D):
-                        string += '_'
-                    else:
-                        string = ""
-                elif len(string) < 8:
-                    string += chr(byte)
-                elif len(string) == 8:
-                    if byte == 0x2E:
-                        string += '.'
-                    else:
-                        string = ""
-                elif len(string) < 11:
-                    string += chr(byte)
-                elif len(string) == 11:
-                    if byte == pattern_2[index][0]:
-                        index += 1
-                        if index == 2:
-                            # Check for "CDDA_END.DA"
-                            if string == "CDDA_END.DA":
-                                # Reset and continue scanning
-                                string = ""
-                                index = 0
-                                continue
-                            else:
-                                # If not CDDA_END.DA, handle normally (e.g., match found)
-                                break
-                    else:
-                        string = ""
-                        index = 0
-
-        # If no Game ID is found, generate one from filename
-        if not string:
-            # Remove spaces from filename and convert to uppercase
-            base_name = os.path.splitext(image)[0]  # Strip the file extension
-            string = re.sub(r'[^A-Z0-9]', '', base_name.upper())  # Keep only A-Z and 0-9
-
-            # Trim the string to 9 characters or pad with zeros
-            string = string[:9].ljust(9, '0')
-
-            # Insert the underscore at position 5 and the full stop at position 9
-            string = string[:4] + '_' + string[4:7] + '.' + string[7:]
-
-            # Ensure the string is exactly 11 characters long
-            string = string[:11]
-
-            print(f'No Game ID found. Generating Game ID based on filename: {string}')
-
-        string = string.upper()
-
         # Determine game name and publisher
-        entry = game_names.get(string)
+        parts = titles.get(string) if titles else None  # title ID, game name, publisher, Japanese title
+        entry = parts[1:] if parts and len(parts) == 4 else None
         if entry:
             game_name, publisher, jpn_title = entry
             if not game_name:
@@ -319,24 +324,78 @@ def process_files(folder, extensions):
         print(f"Game ID '{string}' -> Game='{game_name}', Publisher='{publisher}'")
 
         # Add to game list entries
-        folder_image = re.sub(r'^/(?:__\.)?', '', folder)
+        folder_image = list_folder(folder)
         game_list_entries.append(f"{game_name}|{string}|{publisher}|{folder_image}|{original_image}|{jpn_title}")
 
         count += 1
         print(math.floor((count * 100) / total), '% complete')
 
-    if game_list_entries:
-        with open(games_list_path, "a") as output:
-            for entry in game_list_entries:
-                output.write(f"{entry}\n")
-
+    if pool:
+        pool.terminate()
     done = "Done!"
+    return game_list_entries
+
+def update_list(old_lines, images, entries):
+    # Merge the probed entries into the existing list. Kept entries stay in
+    # place, an image renamed on disk (same size, mtime and inode in the scan
+    # cache) or changed replaces its old entry, new ones go at the end.
+    # Returns the new list and the change set.
+    old = {list_key(line): line for line in old_lines}
+    present = {f"{list_folder(folder)}/{image}": (folder, key, stamp)
+               for folder, image, key, stamp in images}
+    new = {list_key(line): line for line in entries}
+
+    # Old entries gone from disk, by the stamp the cache has for them
+    folders = {list_folder(folder): folder for folder, image, key, stamp in images}
+    gone = {}
+    for old_key, line in old.items():
+        if old_key in present:
+            continue
+        fields = line.split('|')
+        folder = folders.get(fields[3] if len(fields) >= 5 else None)
+        cached = None
+        if folder:
+            cached = cache.get(os.path.relpath(os.path.join(game_path + folder, fields[4]), game_path))
+        gone[old_key] = tuple(cached[:3]) if cached else None
+
+    by_stamp = {stamp: old_key for old_key, stamp in gone.items() if stamp}
+    renamed = {}
+    for new_key in new:
+        if new_key not in old:
+            old_key = by_stamp.pop(tuple(present[new_key][2]), None)
+            if old_key:
+                renamed[old_key] = new_key
+
+    lines = []
+    for line in old_lines:
+        old_key = list_key(line)
+        if old_key in present:
+            lines.append(new.get(old_key, line))
+        elif old_key in renamed:
+            lines.append(new[renamed[old_key]])
+    moved = set(renamed.values())
+    added = [new_key for new_key in new if new_key not in old and new_key not in moved]
+    lines += [new[new_key] for new_key in added]
+
+    changes = {
+        "added": [entry_fields(new[new_key]) for new_key in added],
+        "removed": [entry_fields(old[old_key]) for old_key in gone if old_key not in renamed],
+        "renamed": [{"from": entry_fields(old[old_key]), "to": entry_fields(new[new_key])}
+                    for old_key, new_key in renamed.items()],
+        "changed": [{"from": entry_fields(old[key]), "to": entry_fields(new[key])}
+                    for key in new if key in old and old[key] != new[key]],
+    }
+    return lines, changes
 
 def main(arg1, arg2):
     if arg1 and arg2:
         global game_path
         global games_list_path
         global gameid_file_path
+        global cache
+        global titles
+        global total
+        global done
         game_path = arg1
         games_list_path = arg2
 
@@ -351,34 +410,97 @@ def main(arg1, arg2):
             print("Error: Output list must end with either 'ps2.list' or 'ps1.list'.")
             sys.exit(1)
 
-        # Remove any existing game list file
-        if os.path.isfile(games_list_path):
-            os.remove(games_list_path)
+        # An existing game list is replaced once the new one is written,
+        # --update merges into it
+        old_lines = []
+        if update and os.path.isfile(games_list_path):
+            old_lines = read_list(games_list_path)
 
-        # Count files
+        # List files
+        images = []
         for folder, extensions in folders_to_scan:
             if os.path.isdir(game_path + folder):
-                count_files(folder, extensions)
+                images += scan_files(folder, extensions)
             else:
                 print(f'{folder} not found at ' + game_path)
                 sys.exit(1)
 
-        if total == 0:
+        if not images and not old_lines:
+            if os.path.isfile(games_list_path):
+                os.remove(games_list_path)
             if games_list_path.endswith("ps2.list"):
                 print("No PS2 games found in the CD or DVD folder.")
             elif games_list_path.endswith("ps1.list"):
                 print("No PS1 games found in the POPS folder.")
             sys.exit(0)
 
+        cache = load_cache(cache_path or games_list_path + ".cache")
+
+        # With --update only images missing from the list, or known from the
+        # scan cache to have changed, are processed
+        probe = images
+        if update:
+            listed = set(map(list_key, old_lines))
+            probe = [(folder, image, key, stamp) for folder, image, key, stamp in images
+                     if f"{list_folder(folder)}/{image}" not in listed
+                     or cache.get(key, stamp)[:3] != stamp]
+            print(f"{len(images) - len(probe)} of {len(images)} games unchanged since the last list.")
+        total = len(probe)
+
         # Process files
-        for folder, extensions in folders_to_scan:
-            if os.path.isdir(game_path + folder):
-                process_files(folder, extensions)
+        if os.path.isfile(gameid_file_path):
+            titles = TitlesDB(gameid_file_path)
+        try:
+            entries = process_files(probe)
+        finally:
+            if titles:
+                titles.close()
+
+        if update:
+            lines, changes = update_list(old_lines, images, entries)
+            done = "Done!"
+        else:
+            lines, changes = entries, {"added": [entry_fields(line) for line in entries],
+                                       "removed": [], "renamed": [], "changed": []}
+        write_list(games_list_path, lines)
+
+        if changes_path:
+            with open(changes_path, 'w') as f:
+                json.dump(changes, f, ensure_ascii=False, indent=1)
+        if update:
+            print("%d added, %d removed, %d renamed, %d changed" % tuple(
+                len(changes[kind]) for kind in ("added", "removed", "renamed", "changed")))
+
+        # Keep only the images still present, unchanged ones keep their entry
+        for folder, image, key, stamp in images:
+            if key not in new_cache and key in cache:
+                new_cache[key] = cache[key]
+        save_cache(cache_path or games_list_path + ".cache", new_cache)
 
         print(done)
 
+def usage():
+    print("Usage: build-list.py [-j jobs] [-C cache_file] [--update] [--changes=file] <game_path> <output_list_path>")
+
 if __name__ == "__main__":
-    if len(sys.argv) == 3:
-        main(sys.argv[1], sys.argv[2])
+    try:
+        optlist, args = gnu_getopt(sys.argv[1:], "j:C:", ["update", "changes="])
+    except GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(1)
+
+    for o, a in optlist:
+        if o == '-j':
+            jobs = max(int(a), 1)
+        elif o == '-C':
+            cache_path = a
+        elif o == '--update':
+            update = True
+        elif o == '--changes':
+            changes_path = a
+
+    if len(args) == 2:
+        main(args[0], args[1])
     else:
-        print("Usage: build-list.py <game_path> <output_list_path>")
+        usage()
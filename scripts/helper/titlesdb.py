@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+TitlesDB index from the PSBBN Definitive Project
+Copyright (C) 2024-2026 CosmicScale
+
+<https://github.com/CosmicScale/PSBBN-Definitive-English-Patch>
+
+SPDX-License-Identifier: GPL-3.0-or-later
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import sqlite3
+
+INDEX_VERSION = 1
+
+
+class TitlesDB:
+    # Game ID lookups in a pipe separated database (TitlesDB_PS2.csv,
+    # TitlesDB_PS1.csv, ArtDB.csv) through a sqlite file compiled next to it.
+    # The index is built on the first lookup and again whenever the CSV's
+    # mtime or size changes. If it can't be written, an in-memory index is
+    # used for the run.
+    def __init__(self, csv_path, db_path=None):
+        self.csv_path = csv_path
+        self.db_path = db_path or os.path.splitext(csv_path)[0] + ".db"
+        self.db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def get(self, game_id):
+        # All fields of the row for game_id, the ID first, or None
+        if self.db is None:
+            self.open()
+        row = self.db.execute("SELECT line FROM titles WHERE id = ?", (game_id,)).fetchone()
+        return row[0].split('|') if row else None
+
+    def open(self):
+        st = os.stat(self.csv_path)
+        stamp = "%d:%d:%d" % (INDEX_VERSION, st.st_mtime_ns, st.st_size)
+        try:
+            db = sqlite3.connect("file:%s?mode=ro" % self.db_path, uri=True)
+            if db.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone() == (stamp,):
+                self.db = db
+                return
+            db.close()
+        except sqlite3.Error:
+            pass
+
+        # Build into a temporary file and rename it, so another process
+        # reading the old index is never left with a half written one
+        tmp_path = "%s.%d.tmp" % (self.db_path, os.getpid())
+        try:
+            self.build(tmp_path, stamp)
+            os.replace(tmp_path, self.db_path)
+            self.db = sqlite3.connect("file:%s?mode=ro" % self.db_path, uri=True)
+        except (OSError, sqlite3.Error):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self.db = self.build(":memory:", stamp, keep=True)
+
+    def build(self, path, stamp, keep=False):
+        db = sqlite3.connect(path)
+        db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        db.execute("CREATE TABLE titles (id TEXT PRIMARY KEY, line TEXT)")
+        with open(self.csv_path, 'r', encoding="utf-8") as f:
+            # A repeated ID keeps its last row
+            rows = ((line.split('|', 1)[0], line) for line in (raw.strip() for raw in f) if line)
+            db.executemany("INSERT OR REPLACE INTO titles VALUES (?, ?)", rows)
+        db.execute("INSERT INTO meta VALUES ('stamp', ?)", (stamp,))
+        db.commit()
+        if keep:
+            return db
+        db.close()
@@ -25,20 +25,84 @@ __version__ = "2.0"
 
 import sys
 import os
+import io
+import errno
+import stat
+import json
+import zlib
+import hashlib
+import mmap
+import shutil
 
 import lz4.block
-from struct import pack, unpack
-from multiprocessing import Pool
+from array import array
+from base64 import b64encode, b64decode
+from struct import pack, unpack, error as StructError
+from collections import deque, OrderedDict
+from queue import Queue
+from threading import Thread, Lock, local
+from itertools import count
+from multiprocessing import Pool, cpu_count, shared_memory
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from getopt import gnu_getopt, GetoptError
+from time import perf_counter
 
 ZISO_MAGIC = 0x4F53495A
 DEFAULT_ALIGN = 0
 DEFAULT_BLOCK_SIZE = 0x800
 COMPRESS_THREHOLD = 95
 DEFAULT_PADDING = br'X'
+# Sector size and user data offset of the CUE track modes compress reads
+CUE_MODES = {
+    "MODE1/2048": (2048, 0),
+    "MODE1/2352": (2352, 16),
+    "MODE2/2352": (2352, 24),
+}
 
 MP = False
-MP_NR = 1024 * 16
+MP_NR = 256  # blocks per task handed to a worker
+MP_WINDOW = 0  # tasks in flight, 0 = 4 per worker
+JOBS = None  # worker processes, None = one per core
+MP_ZSO = local()  # per-worker decompression state, per thread with -B thread
+MP_SHM = None  # per-process input mapping, and output slots of the shm backend
+BACKEND = "pipe"  # -m workers: pipe or shm processes, thread, or auto
+AUTO_SERIAL_SECONDS = 2  # -B auto stays serial for jobs estimated below this
+AUTO_THREAD_SHARE = 0.75  # -B auto uses threads when they reach this share of the cores
+AUTO_RUNS = 4  # runs of MP_NR blocks decoded when calibrating -B auto
+BATCH_INFLIGHT = 64 * 1024 * 1024  # decoded bytes in flight across a batch
+BATCH_OPEN = 4  # images a batch worker keeps open
+INFO_MAP = 64  # regions in the compressibility map of info
+INFO_KEEP = 90  # info suggests keeping ZSO files smaller than this percent of the image
+DECODE_COST = None  # seconds per compressed block, timed once by info
+
+PROGRESS = "text"  # text: a percentage line on stderr, json: JSON lines on PROGRESS_FD
+PROGRESS_FD = 2
+PROGRESS_INTERVAL = 1.0  # seconds between JSON progress lines
+PROGRESS_FILE = None
+PROGRESS_OPTIONS = ["progress=", "progress-fd="]
+
+ADAPTIVE = False  # store regions the fast codec can't compress plain
+ADAPTIVE_REGION = 64  # blocks per region probed in adaptive mode
+ADAPTIVE_STRIDE = 4  # probe every n-th block of a region
+ADAPTIVE_REPORT = 16  # plain ranges listed in the summary
+TARGET_RATE = 0  # MB/s to pick the level for, 0 = use -c as given
+LEVEL_SAMPLE = 256  # blocks timed when picking the level
+SECTOR_TABLE = None  # per-sector level table given with -s
+PROFILE_GAP = 16  # hot ranges closer than this many sectors are merged
+
+READER_CACHE_BLOCKS = 256  # decoded blocks kept by ZsoReader
+READER_READAHEAD = 8  # blocks decoded per ZsoReader cache miss
+MOUNT_READAHEAD = 64  # blocks decoded ahead of sequential reads on a mount
+STREAM_BUFFER = 1024 * 1024  # output buffer, and pipe size when writing to a pipe
+
+JOURNAL = False  # checkpoint to a sidecar file and resume from it
+JOURNAL_SUFFIX = ".journal"
+CHECKPOINT_BLOCKS = 1024 * 16  # blocks processed between checkpoints
+CHECKPOINT_CHUNK = 4 * 1024 * 1024  # output bytes covered by one CRC32
+
+VERIFY_HASHES = ["crc32", "md5", "sha1"]  # digests of the image computed by verify
+VERIFY_REPORT = 16  # problems listed by verify
 
 
 def hexdump(data):
@@ -52,46 +116,304 @@ def lz4_compress(plain, level=9):
     return lz4.block.compress(plain, mode=mode, compression=level, store_size=False)
 
 
-def lz4_compress_mp(i):
-    plain = i[0]
-    level = i[1]
-    mode = "high_compression" if level > 1 else "default"
-    return lz4.block.compress(plain, mode=mode, compression=level, store_size=False)
-
-
-def lz4_decompress(compressed, block_size):
-    decompressed = None
+def probe_incompressible(iso_data, start, end, block_size, threshold):
+    # Sample every ADAPTIVE_STRIDE-th non-zero block of a region with the fast
+    # codec, the region is incompressible if none of them pass the threshold
+    zero = bytes(block_size)
+    view = memoryview(iso_data)
+    sampled = 0
+    for pos in range(start, end, block_size * ADAPTIVE_STRIDE):
+        if iso_data.find(zero, pos, pos + block_size) == pos:
+            continue
+        plain = view[pos:pos + block_size]
+        if 100 * len(lz4_compress(plain, 1)) / len(plain) < threshold:
+            return False
+        sampled += 1
+    return sampled > 0
+
+
+def lz4_compress_range(iso_data, start, end, levels, block_size, level, threshold, zero_payload, adaptive):
+    # Compress the blocks in iso_data[start:end], None marks a block that has
+    # to be stored plain. iso_data is bytes or the mapped input file, neither
+    # is copied. All-zero blocks reuse the precomputed zero_payload without
+    # the codec unless their level stores them plain. In adaptive mode, regions found incompressible by
+    # probe_incompressible are stored plain without trying the requested
+    # level; their first block numbers (relative to start) are returned as
+    # well. `levels` optionally holds one level per block and overrides
+    # `level`.
+    zero = bytes(block_size)
+    region_size = ADAPTIVE_REGION * block_size
+    view = memoryview(iso_data)
+    zso_data_all = []
+    plain_regions = []
+    stored = False
+    for pos in range(start, end, block_size):
+        if adaptive and (pos - start) % region_size == 0:
+            stored = probe_incompressible(iso_data, pos, min(pos + region_size, end),
+                                          block_size, threshold)
+            if stored:
+                plain_regions.append((pos - start) // block_size)
+        if levels:
+            # Per-block level from the sector table, 0 stores the block plain
+            level = levels[(pos - start) // block_size]
+        if level != 0 and iso_data.find(zero, pos, pos + block_size) == pos:
+            zso_data_all.append(zero_payload)
+            continue
+        if stored or level == 0:
+            zso_data_all.append(None)
+            continue
+        plain = view[pos:pos + block_size]
+        zso_data = lz4_compress(plain, level)
+        if 100 * len(zso_data) / len(plain) >= threshold:
+            zso_data = None
+        zso_data_all.append(zso_data)
+    return zso_data_all, plain_regions
+
+
+def lz4_compress_mp(task):
+    # lz4_compress_range over a whole batch read by the caller
+    iso_data, levels = task[:2]
+    return lz4_compress_range(iso_data, 0, len(iso_data), levels, *task[2:])
+
+
+def lz4_compressed_size(compressed, block_size):
+    # Walk the sequences of an LZ4 block until block_size bytes have been
+    # produced, the position reached is where the alignment padding starts.
+    # The last sequence of a block only carries literals.
+    pos = 0
+    out = 0
     while True:
-        try:
-            decompressed = lz4.block.decompress(
-                compressed, uncompressed_size=block_size)
-            break
-        except lz4.block.LZ4BlockError:
-            compressed = compressed[:-1]
-    return decompressed
+        token = compressed[pos]
+        pos += 1
+        length = token >> 4
+        if length == 15:
+            while True:
+                byte = compressed[pos]
+                pos += 1
+                length += byte
+                if byte != 255:
+                    break
+        pos += length
+        out += length
+        if out >= block_size:
+            return pos
+
+        pos += 2  # match offset
+        length = token & 15
+        if length == 15:
+            while True:
+                byte = compressed[pos]
+                pos += 1
+                length += byte
+                if byte != 255:
+                    break
+        out += length + 4
+
+
+def lz4_decompress(compressed, block_size, padding=0):
+    # `padding` is the most alignment bytes that can trail the LZ4 data,
+    # None when it is unknown (the last block may be followed by anything)
+    try:
+        if padding is None:
+            compressed = compressed[:lz4_compressed_size(compressed, block_size)]
+        elif padding:
+            # Padding is a run of DEFAULT_PADDING, strip it and decode once
+            tail = bytes(compressed[-padding:]).rstrip(DEFAULT_PADDING)
+            try:
+                return lz4.block.decompress(
+                    compressed[:len(compressed) - padding + len(tail)], uncompressed_size=block_size)
+            except lz4.block.LZ4BlockError:
+                # The LZ4 data itself ends with the padding byte
+                compressed = compressed[:lz4_compressed_size(compressed, block_size)]
+    except IndexError:
+        raise lz4.block.LZ4BlockError("truncated LZ4 block")
+    return lz4.block.decompress(compressed, uncompressed_size=block_size)
 
 
 def usage():
     print("Usage: ziso [-c level] [-m] [-t percent] [-h] infile outfile")
+    print("  infile and outfile can be - for stdin/stdout or a FIFO when decompressing")
+    print("  infile can be a CUE sheet, its first track (%s) is compressed from the BIN" % (", ".join(CUE_MODES)))
     print("  -c level: 1-12 compress ISO to ZSO, 1 for standard compression, >1 for high compression")
     print("              0 decompress ZSO to ISO")
     print("  -b size:  2048-8192, specify block size (2048 by default)")
-    print("  -m Use multiprocessing acceleration for compressing")
+    print("  -m Use multiprocessing acceleration for compressing and decompressing")
+    print("  -j jobs  Number of worker processes, implies -m (one per core by default)")
+    print("  -w window Batches of %d blocks in flight with -m (default 4 per worker)" % (MP_NR))
+    print("  -B backend Workers used by -m, implies -m")
+    print("             pipe: processes fed through the pool (default)")
+    print("             shm: processes mapping the input file, pipe when decompressing")
+    print("             thread: threads, no startup or transfer cost but only the codec runs in parallel")
+    print("             auto: serial, thread or shm/pipe from a quick calibration")
     print("  -t percent Compression Threshold (1-100)")
+    print("  -A Adaptive: store regions the fast codec can't compress plain without trying level")
+    print("  -T rate  Pick the highest level up to -c that compresses at rate MB/s")
+    print("  -s table Per-sector levels, lines of sector:level or start-end:level (0 = plain)")
     print("  -a align Padding alignment 0=small/slow 6=fast/large")
     print("  -p pad Padding byte")
+    print("  -r Journal progress to outfile%s and resume an interrupted run from it" % (JOURNAL_SUFFIX))
+    print("  --progress=json Report progress as JSON lines: blocks, bytes, MB/s, ratio, ETA and")
+    print("                  seconds spent reading, in the codec and writing (also for verify and batch)")
+    print("  --progress-fd=fd File descriptor the progress goes to (2, stderr, by default)")
     print("  -h this help")
+    print("")
+    print("       ziso mount [-r blocks] srcdir mountpoint")
+    print("  Mount srcdir read-only, presenting every ZSO file as an ISO (requires fusepy)")
+    print("  -r blocks Blocks decoded ahead of sequential reads (%d by default)" % (MOUNT_READAHEAD))
+    print("")
+    print("       ziso profile [-l level] [-g gap] lbas [table]")
+    print("  Build a -s table from the LBAs read during boot (lba, lba count or start-end per line)")
+    print("  -l level Level for the hot sectors (1 by default, 0 = plain)")
+    print("  -g gap   Merge hot ranges closer than gap sectors (%d by default)" % (PROFILE_GAP))
+    print("")
+    print("       ziso verify [-j jobs] [-w window] [-H hashes] zsofile [srciso]")
+    print("  Decode every block in memory, check the index and hash the image, compare with srciso if given")
+    print("  -j jobs   Worker processes (one per core by default)")
+    print("  -w window Batches of %d blocks in flight (default 4 per worker)" % (MP_NR))
+    print("  -H hashes Comma separated, %s by default, none to only check the blocks" % (",".join(VERIFY_HASHES)))
+    print("")
+    print("       ziso info [-n regions] [-J] inputs...")
+    print("  Statistics of ZSO files and directories of them from the header and index only,")
+    print("  the index is only checked to fit the file, verify checks every entry")
+    print("  -n regions Regions in the compressibility map (%d by default)" % (INFO_MAP))
+    print("  -J         One JSON object per file instead of text")
+    print("")
+    print("       ziso batch [-j jobs] [-B backend] [-M mb] [-o dir] [-r] [-x] inputs...")
+    print("  Decompress ZSO files and directories of them to ISO on one shared worker pool, largest first")
+    print("  -j jobs   Workers (one per core by default), -B pipe or thread as above")
+    print("  -M mb     Decoded data in flight across all images (%d by default)" % (BATCH_INFLIGHT // 1024 ** 2))
+    print("  -o dir    Write the ISO files to dir instead of next to the ZSO files")
+    print("  -r        Journal every image and resume interrupted ones, as above")
+    print("  -x        Remove every ZSO file once it's converted")
+
+
+class StreamReader:
+    # Forward-only seek over a pipe, skipped bytes are read and dropped
+
+    def __init__(self, fin):
+        self.fin = fin
+        self.pos = 0
+
+    def seekable(self):
+        return False
+
+    def read(self, size=-1):
+        data = self.fin.read(size)
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET or offset < self.pos:
+            raise io.UnsupportedOperation("can't seek backwards in a stream")
+        while self.pos < offset:
+            if not self.read(min(offset - self.pos, STREAM_BUFFER)):
+                break
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.fin.close()
+
+
+class CueReader:
+    # Read-only, seekable view of the user data of the first track of a
+    # CUE/BIN image, as if it had been extracted to an ISO. A read fetches
+    # the raw sectors in one go and joins the 2048 byte payloads, sync,
+    # header, subheader and EDC/ECC are left out.
+
+    def __init__(self, fname_cue):
+        self.name, self.mode, first, last = self.parse(fname_cue)
+        self.sector_size, self.offset = CUE_MODES[self.mode]
+        self.fin = open(self.name, "rb")
+        self.first = first
+        sectors = (os.fstat(self.fin.fileno()).st_size // self.sector_size) - first
+        self.sectors = max(min(sectors, last - first) if last is not None else sectors, 0)
+        self.pos = 0
+
+    @staticmethod
+    def parse(fname_cue):
+        # Tracks as [file, mode, INDEX 00, INDEX 01] in sector numbers
+        tracks = []
+        bin_file = None
+        with open(fname_cue, errors="replace") as f:
+            for line in f:
+                words = line.split()
+                keyword = words[0].upper() if words else ""
+                if keyword == "FILE":
+                    bin_file = line.split('"')[1] if '"' in line else words[1]
+                elif keyword == "TRACK" and len(words) > 2:
+                    tracks.append([bin_file, words[2].upper(), None, None])
+                elif keyword == "INDEX" and tracks and len(words) > 2:
+                    mm, ss, ff = (int(i) for i in words[2].split(":"))
+                    tracks[-1][2 if int(words[1]) == 0 else 3] = (mm * 60 + ss) * 75 + ff
+
+        if not tracks or tracks[0][0] is None or tracks[0][3] is None:
+            raise ValueError("no track found")
+        bin_file, mode, index0, first = tracks[0]
+        if mode not in CUE_MODES:
+            raise ValueError("unsupported track mode %s" % (mode))
+
+        last = None
+        if len(tracks) > 1 and tracks[1][0] == bin_file:
+            # The pregap of the next track isn't part of this one
+            last = tracks[1][2] if tracks[1][2] is not None else tracks[1][3]
+        return os.path.join(os.path.dirname(fname_cue), bin_file), mode, first, last
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            offset += self.sectors * 2048
+        elif whence == os.SEEK_CUR:
+            offset += self.pos
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        total = self.sectors * 2048
+        end = total if size < 0 else min(self.pos + size, total)
+        if end <= self.pos:
+            return b""
+        first, last = self.pos // 2048, (end + 2047) // 2048
+        raw = seek_and_read(self.fin, (self.first + first) * self.sector_size,
+                            (last - first) * self.sector_size)
+        if self.sector_size == 2048:
+            data = raw
+        else:
+            view = memoryview(raw)
+            data = b"".join([view[pos + self.offset:pos + self.offset + 2048]
+                             for pos in range(0, len(raw) - self.sector_size + 1, self.sector_size)])
+        if self.pos != first * 2048 or end != last * 2048:
+            data = data[self.pos - first * 2048:end - first * 2048]
+        self.pos = end
+        return data
+
+    def close(self):
+        self.fin.close()
 
 
-def open_input_output(fname_in, fname_out):
+def is_fifo(f):
+    return stat.S_ISFIFO(os.fstat(f.fileno()).st_mode)
+
+
+def open_input_output(fname_in, fname_out, resume=False):
     try:
-        fin = open(fname_in, "rb")
+        if fname_in == "-":
+            fin = open(sys.__stdin__.fileno(), "rb", closefd=False)
+        else:
+            fin = open(fname_in, "rb")
     except IOError:
         print("Can't open %s" % (fname_in))
         sys.exit(-1)
 
     try:
-        fout = open(fname_out, "wb")
+        fout = open_output(fname_out, resume)
     except IOError:
         print("Can't create %s" % (fname_out))
         sys.exit(-1)
@@ -99,6 +421,166 @@ def open_input_output(fname_in, fname_out):
     return fin, fout
 
 
+def open_output(fname_out, resume=False):
+    if fname_out == "-":
+        fout = open(sys.__stdout__.fileno(), "wb",
+                    buffering=STREAM_BUFFER, closefd=False)
+    elif resume and os.path.isfile(fname_out):
+        # Keep what an interrupted run has written
+        fout = open(fname_out, "r+b", buffering=STREAM_BUFFER)
+    elif resume and not os.path.exists(fname_out):
+        # Checkpoints read back what was written
+        fout = open(fname_out, "w+b", buffering=STREAM_BUFFER)
+    else:
+        fout = open(fname_out, "wb", buffering=STREAM_BUFFER)
+
+    if is_fifo(fout):
+        try:
+            # A larger pipe means fewer wakeups per block run written
+            import fcntl
+            fcntl.fcntl(fout.fileno(), fcntl.F_SETPIPE_SZ, STREAM_BUFFER)
+        except (ImportError, AttributeError, OSError):
+            pass
+
+    return fout
+
+
+class Journal:
+    # Append-only sidecar next to the output file. The first line describes
+    # the job, every checkpoint appends a line with the next block to
+    # process, the output position, the index entries added since the last
+    # checkpoint (compression only) and the CRC32 of the output written so
+    # far in CHECKPOINT_CHUNK pieces. A torn last line is ignored, so a
+    # resume starts from the last checkpoint that made it to disk.
+
+    def __init__(self, fname_out, job):
+        self.fname = fname_out + JOURNAL_SUFFIX
+        self.job = job
+        self.block = 0
+        self.write_pos = 0
+        self.index = bytearray()
+        self.chunks = []
+        self.tail = 0
+        self.record = {}
+        self.f = None
+
+    def load(self):
+        # True when a journal for the same job has at least one checkpoint
+        try:
+            with open(self.fname) as f:
+                lines = f.read().split("\n")
+            if json.loads(lines[0]) != self.job:
+                return False
+        except (IOError, ValueError):
+            return False
+
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            self.block, self.write_pos = record["block"], record["pos"]
+            self.index += b64decode(record["index"])
+            self.chunks += record["chunks"]
+            self.tail = record["tail"]
+            self.record = record
+        return self.block > 0
+
+    @staticmethod
+    def crc_chunks(fd, start, end):
+        chunks = []
+        tail = 0
+        pos = start
+        while pos < end:
+            size = min(CHECKPOINT_CHUNK, end - pos)
+            crc = zlib.crc32(os.pread(fd, size, pos))
+            if size == CHECKPOINT_CHUNK:
+                chunks.append(crc)
+            else:
+                tail = crc
+            pos += size
+        return chunks, tail
+
+    def verify(self, fout):
+        fd = fout.fileno()
+        if os.fstat(fd).st_size < self.write_pos:
+            return False
+        return self.crc_chunks(fd, 0, self.write_pos) == (self.chunks, self.tail)
+
+    def reset(self):
+        self.__init__(self.fname[:-len(JOURNAL_SUFFIX)], self.job)
+
+    def checkpoint(self, fout, block, write_pos, index_buf=None, **extra):
+        fout.flush()
+        fd = fout.fileno()
+        if os.fstat(fd).st_size < write_pos:
+            # Trailing zero blocks were only seeked over
+            os.ftruncate(fd, write_pos)
+        os.fsync(fd)
+
+        chunks, self.tail = self.crc_chunks(
+            fd, len(self.chunks) * CHECKPOINT_CHUNK, write_pos)
+        self.chunks += chunks
+        index = index_buf[self.block:block].tobytes() if index_buf else b""
+
+        if self.f is None:
+            if self.block:
+                self.f = open(self.fname, "a")
+            else:
+                self.f = open(self.fname, "w")
+                self.f.write(json.dumps(self.job) + "\n")
+        record = dict(extra, block=block, pos=write_pos, index=b64encode(index).decode(),
+                      chunks=chunks, tail=self.tail)
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.block = block
+        self.write_pos = write_pos
+
+    def due(self, block):
+        return block - self.block >= CHECKPOINT_BLOCKS
+
+    def remove(self):
+        if self.f:
+            self.f.close()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+
+def can_resume(fname_in):
+    # -r needs the input by name to tell whether it changed, which stdin
+    # and FIFOs don't allow. Decided before the output is opened, so an
+    # output that won't be resumed is truncated like any other.
+    if JOURNAL and (fname_in == "-" or not os.path.isfile(fname_in)):
+        print("Journal needs a regular input file, ignoring -r")
+        return False
+    return JOURNAL
+
+
+def open_journal(fname_in, fname_out, fout, job):
+    # Returns the journal and the block to start from, 0 for a fresh run
+    if not stat.S_ISREG(os.fstat(fout.fileno()).st_mode):
+        print("Journal needs a regular output file, ignoring -r")
+        return None, 0
+
+    st = os.stat(fname_in)
+    job = dict(job, input=[st.st_size, st.st_mtime_ns], chunk=CHECKPOINT_CHUNK)
+    journal = Journal(fname_out, job)
+    if journal.load():
+        if journal.verify(fout):
+            print("resuming        block %d (%d bytes written)" % (
+                journal.block, journal.write_pos))
+            fout.truncate(journal.write_pos)
+            fout.seek(journal.write_pos)
+            return journal, journal.block
+        print("Existing output doesn't match %s, starting over" % (journal.fname))
+        journal.reset()
+
+    fout.seek(0)
+    fout.truncate()
+    return journal, 0
+
+
 def seek_and_read(fin, offset, size):
     fin.seek(offset)
     return fin.read(size)
@@ -112,6 +594,30 @@ def read_zso_header(fin):
     return magic, header_size, total_bytes, block_size, ver, align
 
 
+def check_zso_header(fin):
+    # The header fields, or None if fin doesn't start with a ZSO header
+    # this script can read
+    try:
+        header = read_zso_header(fin)
+    except StructError:
+        return None
+    magic, header_size, total_bytes, block_size, ver, align = header
+    if magic != ZISO_MAGIC or block_size == 0 or total_bytes == 0 or header_size != 24 or ver > 1:
+        return None
+    return header
+
+
+def read_zso_index(fin, total_block):
+    # The index follows the header, load all of it with a single read
+    # A truncated file can end inside an entry, that entry is left out
+    index_buf = array('I')
+    data = fin.read(4 * (total_block + 1))
+    index_buf.frombytes(data[:len(data) & ~3])
+    if sys.byteorder == 'big':
+        index_buf.byteswap()
+    return index_buf
+
+
 def generate_zso_header(magic, header_size, total_bytes, block_size, ver, align):
     data = pack('IIQIbbxx', magic, header_size,
                 total_bytes, block_size, ver, align)
@@ -127,35 +633,21 @@ def show_zso_info(fname_in, fname_out, total_bytes, block_size, total_block, ver
     print("version         %d" % (ver))
 
 
-def decompress_zso(fname_in, fname_out):
-    fin, fout = open_input_output(fname_in, fname_out)
-    magic, header_size, total_bytes, block_size, ver, align = read_zso_header(
-        fin)
-
-    if magic != ZISO_MAGIC or block_size == 0 or total_bytes == 0 or header_size != 24 or ver > 1:
-        print("ziso file format error")
-        return -1
-
-    total_block = total_bytes // block_size
-    index_buf = []
-
-    for _ in range(total_block + 1):
-        index_buf.append(unpack('I', fin.read(4))[0])
-
-    show_zso_info(fname_in, fname_out, total_bytes,
-                  block_size, total_block, ver, align)
-
-    block = 0
-    percent_period = total_block/100
-    percent_cnt = 0
-
-    while block < total_block:
-        percent_cnt += 1
-        if percent_cnt >= percent_period and percent_period != 0:
-            percent_cnt = 0
-            print("decompress %d%%\r" %
-                  (block / percent_period), file=sys.stderr, end='\r')
+def decompress_zso_run(fin, index_buf, start, end, block_size, total_block, align, times=None):
+    # Decode blocks [start, end) from one contiguous read of their data,
+    # `times` gets the read and codec seconds added when given
+    run_pos = (index_buf[start] & 0x7fffffff) << align
+    if end == total_block:
+        # The last block may be followed by padding, read up to EOF
+        run_size = -1
+    else:
+        run_size = ((index_buf[end] & 0x7fffffff) << align) - run_pos
+    read_start = perf_counter()
+    run_data = memoryview(seek_and_read(fin, run_pos, run_size))
+    codec_start = perf_counter()
 
+    dec_data = []
+    for block in range(start, end):
         index = index_buf[block]
         plain = index & 0x80000000
         index &= 0x7fffffff
@@ -163,36 +655,413 @@ def decompress_zso(fname_in, fname_out):
 
         if plain:
             read_size = block_size
+        elif block == total_block - 1:
+            read_size = len(run_data) - (read_pos - run_pos)
         else:
             index2 = index_buf[block+1] & 0x7fffffff
             # Have to read more bytes if align was set
             read_size = (index2-index) << (align)
-            if block == total_block - 1:
-                read_size = total_bytes - read_pos
 
-        zso_data = seek_and_read(fin, read_pos, read_size)
+        zso_data = run_data[read_pos - run_pos:read_pos - run_pos + read_size]
 
         if plain:
-            dec_data = zso_data
+            block_data = zso_data
         else:
+            if block == total_block - 1:
+                padding = None
+            else:
+                padding = (1 << align) - 1
             try:
-                dec_data = lz4_decompress(zso_data, block_size)
-
+                block_data = lz4_decompress(zso_data, block_size, padding)
             except Exception as e:
-                print("%d block: 0x%08X %d %s" %
-                      (block, read_pos, read_size, e))
-                sys.exit(-1)
+                raise ValueError("%d block: 0x%08X %d %s" %
+                                 (block, read_pos, read_size, e))
+
+        if (len(block_data) != block_size):
+            raise ValueError("%d block: 0x%08X %d" %
+                             (block, read_pos, read_size))
+
+        dec_data.append(block_data)
+
+    if times is not None:
+        times["read"] += codec_start - read_start
+        times["codec"] += perf_counter() - codec_start
+    return b"".join(dec_data)
 
-        if (len(dec_data) != block_size):
-            print("%d block: 0x%08X %d" %
-                  (block, read_pos, read_size))
+
+class ZsoReader(io.RawIOBase):
+    # Seekable, read-only file view of the uncompressed image in a ZSO file.
+    # Decoded blocks are kept in a bounded LRU cache, a miss decodes a run of
+    # `readahead` blocks from one read.
+
+    def __init__(self, fname, cache_blocks=READER_CACHE_BLOCKS, readahead=READER_READAHEAD):
+        super().__init__()
+        self.fin = open(fname, "rb")
+        try:
+            header = check_zso_header(self.fin)
+            if header is None:
+                raise ValueError("ziso file format error: %s" % (fname))
+            magic, header_size, total_bytes, block_size, ver, align = header
+            self.total_block = total_bytes // block_size
+            self.index_buf = read_zso_index(self.fin, self.total_block)
+        except Exception:
+            self.fin.close()
+            raise
+
+        self.name = fname
+        self.total_bytes = total_bytes
+        self.block_size = block_size
+        self.align = align
+        self.size = self.total_block * block_size
+        self.cache_blocks = max(cache_blocks, readahead, 1)
+        self.readahead = max(readahead, 1)
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == os.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("invalid whence (%r)" % (whence))
+        if pos < 0:
+            raise ValueError("negative seek position %d" % (pos))
+        self.pos = pos
+        return pos
+
+    def read_block(self, block):
+        dec_data = self.cache.get(block)
+        if dec_data is not None:
+            self.hits += 1
+            self.cache.move_to_end(block)
+            return dec_data
+
+        self.misses += 1
+        # Read ahead up to the next block that is still cached
+        limit = min(block + self.readahead, self.total_block)
+        end = block + 1
+        while end < limit and end not in self.cache:
+            end += 1
+        run_data = decompress_zso_run(self.fin, self.index_buf, block, end,
+                                      self.block_size, self.total_block, self.align)
+        for i in range(block, end):
+            pos = (i - block) * self.block_size
+            self.cache[i] = run_data[pos:pos + self.block_size]
+            self.cache.move_to_end(i)
+        while len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return self.cache[block]
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        size = max(min(len(view), self.size - self.pos), 0)
+        done = 0
+        while done < size:
+            block, offset = divmod(self.pos + done, self.block_size)
+            dec_data = self.read_block(block)
+            nr = min(self.block_size - offset, size - done)
+            view[done:done + nr] = dec_data[offset:offset + nr]
+            done += nr
+        self.pos += done
+        return done
+
+    def close(self):
+        if not self.closed:
+            self.fin.close()
+            self.cache.clear()
+        super().close()
+
+
+def start_pool(jobs, initializer=None, initargs=()):
+    # Worker pool for BACKEND, submit(fn, arg) returns a function waiting
+    # for the result. Threads get no pickling and no startup cost, but only
+    # the codec itself runs in parallel.
+    if BACKEND == "thread":
+        pool = ThreadPoolExecutor(jobs, initializer=initializer, initargs=initargs)
+        return pool, lambda fn, arg: pool.submit(fn, arg).result
+    pool = Pool(jobs, initializer, initargs)
+    return pool, lambda fn, arg: pool.apply_async(fn, (arg,)).get
+
+
+def init_decompress_mp(fname_in, index_buf, block_size, total_block, align):
+    MP_ZSO.run = (open(fname_in, "rb"), index_buf, block_size, total_block, align)
+
+
+def decompress_zso_mp_run(task):
+    start, end = task
+    fin, index_buf, block_size, total_block, align = MP_ZSO.run
+    return decompress_zso_run(fin, index_buf, start, end, block_size, total_block, align)
+
+
+class Progress:
+    # Progress of one job in blocks of `unit` bytes. Text mode prints a
+    # percentage line whenever it changes, json mode a line with the
+    # counters every PROGRESS_INTERVAL seconds and when the job is done.
+    # Stage times are seen from this process: with workers, "codec" is the
+    # time spent waiting for their results.
+
+    def __init__(self, label, total, unit, done=0):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.first = self.last = done
+        self.start = self.last_time = perf_counter()
+        self.percent = -1
+        self.times = {"read": 0.0, "codec": 0.0, "write": 0.0}
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += perf_counter() - start
+
+    def update(self, done, bytes_in=None, bytes_out=None):
+        if PROGRESS == "json":
+            now = perf_counter()
+            if now - self.last_time >= PROGRESS_INTERVAL or done >= self.total:
+                self.emit(now, done, bytes_in, bytes_out)
+            return
+
+        percent = 100 * done // self.total if self.total else 100
+        if percent == self.percent:
+            return
+        self.percent = percent
+        if self.label == "compress":
+            rate = 100 * bytes_out // (done * self.unit) if done else 0
+            print("compress %3d%% avarage rate %3d%%\r" % (
+                percent, rate), file=sys.stderr, end='\r')
+        else:
+            print("%s %d%%\r" % (self.label, percent), file=sys.stderr, end='\r')
+
+    def emit(self, now, done, bytes_in, bytes_out):
+        global PROGRESS_FILE
+        if PROGRESS_FILE is None:
+            PROGRESS_FILE = open(PROGRESS_FD, "w", closefd=False)
+
+        elapsed = now - self.start
+        rate = (done - self.last) * self.unit / max(now - self.last_time, 1e-9)
+        average = (done - self.first) * self.unit / max(elapsed, 1e-9)
+        # ZSO size over image size whichever way the job goes
+        ratio = None
+        if bytes_in and bytes_out:
+            ratio = bytes_out / bytes_in if self.label == "compress" else bytes_in / bytes_out
+        record = {
+            "op": self.label,
+            "blocks": done,
+            "total_blocks": self.total,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "mbps": round(rate / 1024 ** 2, 2),
+            "avg_mbps": round(average / 1024 ** 2, 2),
+            "ratio": round(ratio, 4) if ratio else None,
+            "eta": round((self.total - done) * self.unit / average, 1) if average else None,
+            "elapsed": round(elapsed, 3),
+            "stages": {name: round(t, 3) for name, t in self.times.items()},
+        }
+        PROGRESS_FILE.write(json.dumps(record) + "\n")
+        PROGRESS_FILE.flush()
+        self.last, self.last_time = done, now
+
+
+def parse_progress_option(o, a):
+    # --progress and --progress-fd are taken by every mode
+    global PROGRESS, PROGRESS_FD
+    if o == '--progress':
+        if a not in ("text", "json"):
+            print("Unknown progress format %s, use text or json" % (a))
             sys.exit(-1)
+        PROGRESS = a
+    else:
+        PROGRESS_FD = int(a)
+
+
+def is_sparse(fout):
+    # Only a regular file this run opened by name reads back zeros where it
+    # was seeked over: it is opened "wb" or truncated by open_journal, and
+    # the end is truncated after the last block. A block device, or a file
+    # handed over as stdout, keeps its old data.
+    if not isinstance(getattr(fout, "name", None), str):
+        return False
+    try:
+        return stat.S_ISREG(os.fstat(fout.fileno()).st_mode)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return False
 
+
+def write_sparse(fout, dec_data, block_size, sparse):
+    # Seek over all-zero blocks instead of writing them, so the output file
+    # gets holes. Outputs that aren't sparse get the zeros written out.
+    if not sparse:
         fout.write(dec_data)
-        block += 1
+        return
+
+    zero = bytes(block_size)
+    view = memoryview(dec_data)
+    size = len(dec_data)
+    pos = 0
+    while pos < size:
+        start = pos
+        while pos < size and not dec_data.startswith(zero, pos):
+            pos += block_size
+        if start < pos:
+            fout.write(view[start:pos])
+        start = pos
+        while pos < size and dec_data.startswith(zero, pos):
+            pos += block_size
+        if start < pos:
+            fout.seek(pos - start, os.SEEK_CUR)
+
+
+def decompress_zso_mp(fname_in, fout, index_buf, block_size, total_block, align, block, journal, progress):
+    # Workers decode ranges of MP_NR blocks from their own file handle, the
+    # ranges are written back in order with at most `window` in flight.
+    window = MP_WINDOW or 4 * JOBS
+    pending = deque()
+    sparse = is_sparse(fout)
+
+    def write_range():
+        nonlocal block
+        nr, result = pending.popleft()
+        try:
+            with progress.stage("codec"):
+                dec_data = result()
+            with progress.stage("write"):
+                write_sparse(fout, dec_data, block_size, sparse)
+        except ValueError as e:
+            print(e)
+            sys.exit(-1)
+        block += nr
+        progress.update(block, (index_buf[block] & 0x7fffffff) << align, block * block_size)
+        if journal and journal.due(block):
+            journal.checkpoint(fout, block, block * block_size)
+
+    pool, submit = start_pool(JOBS, init_decompress_mp,
+                              (fname_in, index_buf, block_size, total_block, align))
+    with pool:
+        for start in range(block, total_block, MP_NR):
+            end = min(start + MP_NR, total_block)
+            pending.append((end - start, submit(decompress_zso_mp_run, (start, end))))
+            if len(pending) >= window:
+                write_range()
+
+        while pending:
+            write_range()
+
+
+def splice_plain_run(fin, fout, index_buf, start, end, block_size, align):
+    # Move a run of plain, back to back blocks from the input file straight
+    # into the output pipe without copying it through Python
+    read_pos = (index_buf[start] & 0x7fffffff) << align
+    for block in range(start, end):
+        index = index_buf[block]
+        if not index & 0x80000000 or (index & 0x7fffffff) << align != read_pos + (block - start) * block_size:
+            return False
+
+    fout.flush()
+    size = (end - start) * block_size
+    done = 0
+    while done < size:
+        nr = os.splice(fin.fileno(), fout.fileno(), size - done,
+                       offset_src=read_pos + done)
+        if nr == 0:
+            raise ValueError("%d block: 0x%08X %d unexpected end of file" %
+                             (start, read_pos, size))
+        done += nr
+    return True
+
+
+def decompress_zso(fname_in, fname_out):
+    global MP, BACKEND
+
+    resume = can_resume(fname_in)
+    fin, fout = open_input_output(fname_in, fname_out, resume)
+    if not fin.seekable():
+        # Data is read in order, so a pipe or FIFO input works when skipping
+        # forward over padding, the workers can't open it on their own though
+        fin = StreamReader(fin)
+        MP = False
+    elif fname_in == "-":
+        # Workers open the input by name, stdin has none
+        MP = False
+
+    header = check_zso_header(fin)
+    if header is None:
+        print("ziso file format error")
+        return -1
+    magic, header_size, total_bytes, block_size, ver, align = header
 
+    total_block = total_bytes // block_size
+    index_buf = read_zso_index(fin, total_block)
+
+    show_zso_info(fname_in, fname_out, total_bytes,
+                  block_size, total_block, ver, align)
+    if MP and BACKEND == "auto":
+        BACKEND, serial = pick_backend(total_bytes, *calibrate_decompress(
+            fin, index_buf, block_size, total_block, align), "pipe")
+        MP = BACKEND != "serial"
+        print("auto backend    %s (%.1fs estimated serially)" % (BACKEND, serial))
+
+    journal, start_block = None, 0
+    if resume:
+        journal, start_block = open_journal(fname_in, fname_out, fout, {
+            "mode": "decompress", "block_size": block_size})
+
+    # Plain runs from a regular file into a pipe don't need to pass through
+    # userspace at all
+    splice = hasattr(os, "splice") and isinstance(fin, io.BufferedReader) \
+        and not is_fifo(fin) and is_fifo(fout)
+
+    progress = Progress("decompress", total_block, block_size, start_block)
+    sparse = is_sparse(fout)
+    if MP:
+        decompress_zso_mp(fname_in, fout, index_buf, block_size,
+                          total_block, align, start_block, journal, progress)
+    else:
+        for start in range(start_block, total_block, MP_NR):
+            end = min(start + MP_NR, total_block)
+            bytes_in = (index_buf[end] & 0x7fffffff) << align
+            try:
+                with progress.stage("write"):
+                    spliced = splice and splice_plain_run(
+                        fin, fout, index_buf, start, end, block_size, align)
+                if spliced:
+                    progress.update(end, bytes_in, end * block_size)
+                    continue
+                dec_data = decompress_zso_run(fin, index_buf, start, end, block_size,
+                                              total_block, align, progress.times)
+            except ValueError as e:
+                print(e)
+                sys.exit(-1)
+
+            with progress.stage("write"):
+                write_sparse(fout, dec_data, block_size, sparse)
+            progress.update(end, bytes_in, end * block_size)
+            if journal and journal.due(end):
+                journal.checkpoint(fout, end, end * block_size)
+
+    if sparse:
+        # Zero blocks at the end were only seeked over
+        fout.truncate(fout.tell())
     fin.close()
     fout.close()
+    if journal:
+        journal.remove()
     print("ziso decompress completed")
 
 
@@ -205,6 +1074,9 @@ def show_comp_info(fname_in, fname_out, total_bytes, block_size, ver, align, lev
     print("version         %d" % (ver))
     if MP:
         print("multiprocessing %s" % (MP))
+        print("worker procs    %d" % (JOBS))
+        print("backend         %s" % (BACKEND))
+        print("batches queued  %d" % (MP_WINDOW or 4 * JOBS))
 
 
 def set_align(fout, write_pos, align):
@@ -216,8 +1088,367 @@ def set_align(fout, write_pos, align):
     return write_pos
 
 
+def write_zso_block(fout, write_pos, index_buf, block, iso_data, zso_data, align):
+    write_pos = set_align(fout, write_pos, align)
+    index_buf[block] = write_pos >> align
+
+    if zso_data is None:
+        zso_data = iso_data
+        index_buf[block] |= 0x80000000  # Mark as plain
+    elif index_buf[block] & 0x80000000:
+        print(
+            "Align error, you have to increase align by 1 or OPL won't be able to read offset above 2 ** 31 bytes")
+        sys.exit(1)
+
+    fout.write(zso_data)
+    return write_pos + len(zso_data)
+
+
+def write_zso_batch(fout, write_pos, index_buf, block, iso_data, result, block_size, align, zero_payload, stats):
+    zso_data_all, plain_regions = result
+    stats["plain_regions"].extend(block + i for i in plain_regions)
+    view = memoryview(iso_data)
+    for i, zso_data in enumerate(zso_data_all):
+        if zso_data == zero_payload:
+            stats["zero_blocks"] += 1
+        write_pos = write_zso_block(fout, write_pos, index_buf, block + i,
+                                    view[i * block_size:(i + 1) * block_size], zso_data, align)
+    return write_pos
+
+
+def show_comp_summary(stats, total_block, block_size, level):
+    print("zero blocks     %d" % (stats["zero_blocks"]))
+    if not ADAPTIVE:
+        return
+
+    total_region = (total_block + ADAPTIVE_REGION - 1) // ADAPTIVE_REGION
+    plain_regions = stats["plain_regions"]
+    print("adaptive        %d of %d regions stored plain without level %d (%d MB)" % (
+        len(plain_regions), total_region, level,
+        len(plain_regions) * ADAPTIVE_REGION * block_size // 1024 ** 2))
+
+    # Merge neighbouring regions into block ranges
+    ranges = []
+    for block in plain_regions:
+        end = min(block + ADAPTIVE_REGION, total_block)
+        if ranges and ranges[-1][1] == block:
+            ranges[-1][1] = end
+        else:
+            ranges.append([block, end])
+    for start, end in ranges[:ADAPTIVE_REPORT]:
+        print("  plain blocks  %d-%d" % (start, end - 1))
+    if len(ranges) > ADAPTIVE_REPORT:
+        print("  ... %d more ranges" % (len(ranges) - ADAPTIVE_REPORT))
+
+
+def pick_level(fin, total_block, block_size, max_level, target, workers):
+    # Time every level on a sample of compressible blocks spread over the
+    # image and return the highest one that keeps up with `target` MB/s
+    zero = bytes(block_size)
+    threshold = min(COMPRESS_THREHOLD, 100)
+    sample = []
+    for block in range(0, total_block, max(total_block // LEVEL_SAMPLE, 1)):
+        plain = seek_and_read(fin, block * block_size, block_size)
+        if plain != zero and 100 * len(lz4_compress(plain, 1)) / len(plain) < threshold:
+            sample.append(plain)
+    fin.seek(0)
+
+    if not sample:
+        return max_level, 0
+    for level in range(max_level, 0, -1):
+        start = perf_counter()
+        for plain in sample:
+            lz4_compress(plain, level)
+        rate = workers * len(sample) * block_size / \
+            max(perf_counter() - start, 1e-9) / 1024 ** 2
+        if rate >= target:
+            return level, rate
+    return 1, rate
+
+
+def pick_backend(total_bytes, sample_bytes, elapsed, codec_elapsed, processes):
+    # Extrapolate the serial time from the sample and weigh threads, which
+    # only overlap the codec, against processes with their startup and
+    # transfer costs. Returns the backend, "serial" included, and the
+    # serial estimate in seconds.
+    serial = total_bytes * elapsed / max(sample_bytes, 1)
+    share = min(codec_elapsed / max(elapsed, 1e-9), 1)
+    threads = 1 / ((1 - share) + share / JOBS)
+    if JOBS == 1 or serial < AUTO_SERIAL_SECONDS:
+        return "serial", serial
+    if threads >= AUTO_THREAD_SHARE * JOBS:
+        return "thread", serial
+    return processes, serial
+
+
+def calibrate_compress(fin, total_block, block_size, opts):
+    # Time a batch of blocks spread over the image, whole and codec only
+    level, zero = opts[1], bytes(block_size)
+    sample = [seek_and_read(fin, block * block_size, block_size)
+              for block in range(0, total_block, max(total_block // LEVEL_SAMPLE, 1))]
+    fin.seek(0)
+
+    start = perf_counter()
+    lz4_compress_mp((b"".join(sample), None) + opts)
+    elapsed = perf_counter() - start
+
+    start = perf_counter()
+    for plain in sample:
+        if plain != zero:
+            lz4_compress(plain, level)
+    return len(sample) * block_size, elapsed, perf_counter() - start
+
+
+def calibrate_decompress(fin, index_buf, block_size, total_block, align):
+    # Time AUTO_RUNS runs spread over the image, whole and codec only
+    runs = []
+    for start in range(0, total_block, max(total_block // AUTO_RUNS, MP_NR)):
+        runs.append((start, min(start + MP_NR, total_block - 1)))
+
+    start_time = perf_counter()
+    for start, end in runs:
+        decompress_zso_run(fin, index_buf, start, end, block_size, total_block, align)
+    elapsed = perf_counter() - start_time
+
+    codec_elapsed = 0
+    padding = (1 << align) - 1
+    for start, end in runs:
+        for block in range(start, end):
+            index, index2 = index_buf[block], index_buf[block + 1] & 0x7fffffff
+            if index & 0x80000000:
+                continue
+            zso_data = seek_and_read(fin, index << align, (index2 - index) << align)
+            start_time = perf_counter()
+            lz4_decompress(zso_data, block_size, padding)
+            codec_elapsed += perf_counter() - start_time
+    return sum(end - start for start, end in runs) * block_size, elapsed, codec_elapsed
+
+
+def read_batches(fin, block, total_block, block_size, queue, progress):
+    # Reader stage: feed runs of MP_NR blocks to the bounded queue
+    while block < total_block:
+        nr = min(total_block - block, MP_NR)
+        with progress.stage("read"):
+            iso_data = fin.read(nr * block_size)
+        queue.put(iso_data)
+        block += nr
+    queue.put(None)
+
+
+def compress_zso_mp(fin, fout, block, total_block, align, index_buf, write_pos, levels, opts, stats, journal, progress, fname_in=None, mm=None):
+    # Workers and this ordered writer run at once, with at most `window`
+    # batches being compressed, so memory use does not depend on the image
+    # size. With the input mapped as `mm`, workers map it too and only get
+    # block ranges. Otherwise a reader thread feeds the batches through a
+    # queue of `window` batches.
+    block_size, level, zero_payload = opts[0], opts[1], opts[3]
+    window = MP_WINDOW or 4 * JOBS
+    pending = deque()
+
+    def write_batch():
+        nonlocal write_pos, block
+        iso_data, result = pending.popleft()
+        try:
+            with progress.stage("codec"):
+                result = result()
+        except Exception as e:
+            print("%d block: %s" % (block, e))
+            sys.exit(-1)
+
+        with progress.stage("write"):
+            write_pos = write_zso_batch(fout, write_pos, index_buf, block, iso_data, result,
+                                        block_size, align, zero_payload, stats)
+        block += len(iso_data) // block_size
+        progress.update(block, block * block_size, write_pos)
+        if journal and journal.due(block):
+            journal.checkpoint(fout, block, write_pos, index_buf, level=level)
+
+    def compress_shared(task):
+        # Threads compress straight from this process' mapping
+        start, end, batch_levels = task
+        return lz4_compress_range(mm, start * block_size, end * block_size, batch_levels, *opts)
+
+    def mapped_batches():
+        view = memoryview(mm)
+        compress = compress_shared if BACKEND == "thread" else lz4_compress_map
+        for start in range(block, total_block, MP_NR):
+            end = min(start + MP_NR, total_block)
+            yield view[start * block_size:end * block_size], submit(compress, (
+                start, end, levels[start:end].tobytes() if levels else None))
+
+    def read_batches_from(queue):
+        submitted = block
+        while True:
+            iso_data = queue.get()
+            if iso_data is None:
+                break
+            nr = len(iso_data) // block_size
+            batch_levels = levels[submitted:submitted + nr].tobytes() if levels else None
+            submitted += nr
+            yield iso_data, submit(lz4_compress_mp, (iso_data, batch_levels) + opts)
+
+    reader = None
+    if mm is not None:
+        # Worker processes map the input themselves, threads share `mm`
+        if BACKEND == "thread":
+            pool, submit = start_pool(JOBS)
+        else:
+            pool, submit = start_pool(JOBS, init_compress_shm, (fname_in, [], opts))
+        batches = mapped_batches()
+    else:
+        queue = Queue(maxsize=window)
+        reader = Thread(target=read_batches, args=(
+            fin, block, total_block, block_size, queue, progress), daemon=True)
+        reader.start()
+        pool, submit = start_pool(JOBS)
+        batches = read_batches_from(queue)
+
+    with pool:
+        for batch in batches:
+            pending.append(batch)
+            if len(pending) >= window:
+                write_batch()
+
+        while pending:
+            write_batch()
+
+    if reader:
+        reader.join()
+    return write_pos
+
+
+def map_input(fin):
+    # Read-only mapping of the whole input, the kernel is told it's read
+    # front to back so read-ahead stays ahead of the codec
+    mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm
+
+
+def init_compress_shm(fname_in, slot_names, opts):
+    global MP_SHM
+    fin = open(fname_in, "rb")
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    MP_SHM = (fin, map_input(fin), slots, opts)
+
+
+def lz4_compress_map(task):
+    # Compress blocks [start, end) straight from the worker's own mapping of
+    # the input, only the block range comes in
+    start, end, levels = task
+    fin, mm, slots, opts = MP_SHM
+    block_size = opts[0]
+    return lz4_compress_range(mm, start * block_size, end * block_size, levels, *opts)
+
+
+def lz4_compress_shm(task):
+    # lz4_compress_map with the payloads going back to back into output slot
+    # `slot`. Only their sizes are returned: -1 plain, -2 the zero payload.
+    start, end, levels, slot = task
+    fin, mm, slots, opts = MP_SHM
+    zero_payload = opts[3]
+    zso_data_all, plain_regions = lz4_compress_map((start, end, levels))
+
+    buf = slots[slot].buf
+    sizes = array('i')
+    pos = 0
+    for zso_data in zso_data_all:
+        if zso_data is None:
+            sizes.append(-1)
+        elif zso_data is zero_payload:
+            sizes.append(-2)
+        else:
+            buf[pos:pos + len(zso_data)] = zso_data
+            sizes.append(len(zso_data))
+            pos += len(zso_data)
+    return sizes.tobytes(), plain_regions
+
+
+def compress_zso_shm(fname_in, mm, fout, block, total_block, align, index_buf, write_pos, levels, opts, stats, journal, progress):
+    # Same pipeline as compress_zso_mp on a mapped input, but workers write
+    # into shared memory slots, so only block ranges and payload sizes are
+    # pickled. Plain blocks are written from this process' mapping `mm`.
+    block_size, level, zero_payload = opts[0], opts[1], opts[3]
+    window = MP_WINDOW or 4 * JOBS
+    slots = []
+    pending = deque()
+
+    def write_batch():
+        nonlocal write_pos, block
+        nr, slot, result = pending.popleft()
+        try:
+            with progress.stage("codec"):
+                sizes, plain_regions = result.get()
+        except Exception as e:
+            print("%d block: %s" % (block, e))
+            sys.exit(-1)
+
+        buf = slots[slot].buf
+        zso_data_all = []
+        pos = 0
+        for size in array('i', sizes):
+            if size == -1:
+                zso_data_all.append(None)
+            elif size == -2:
+                zso_data_all.append(zero_payload)
+            else:
+                zso_data_all.append(buf[pos:pos + size])
+                pos += size
+
+        iso_data = memoryview(mm)[block * block_size:(block + nr) * block_size]
+        with progress.stage("write"):
+            write_pos = write_zso_batch(fout, write_pos, index_buf, block, iso_data,
+                                        (zso_data_all, plain_regions), block_size, align,
+                                        zero_payload, stats)
+        # Release the views before the slot and the mapping can be closed
+        del zso_data_all, iso_data
+        free.append(slot)
+        block += nr
+        progress.update(block, block * block_size, write_pos)
+        if journal and journal.due(block):
+            journal.checkpoint(fout, block, write_pos, index_buf, level=level)
+
+    try:
+        for i in range(window):
+            slots.append(shared_memory.SharedMemory(create=True, size=MP_NR * block_size))
+        free = deque(range(window))
+        with Pool(JOBS, init_compress_shm, (fname_in, [s.name for s in slots], opts)) as pool:
+            for start in range(block, total_block, MP_NR):
+                if not free:
+                    write_batch()
+                end = min(start + MP_NR, total_block)
+                slot = free.popleft()
+                pending.append((end - start, slot, pool.apply_async(lz4_compress_shm, (
+                    (start, end, levels[start:end].tobytes() if levels else None, slot),))))
+
+            while pending:
+                write_batch()
+    finally:
+        for s in slots:
+            s.close()
+            s.unlink()
+
+    return write_pos
+
+
 def compress_zso(fname_in, fname_out, level, bsize):
-    fin, fout = open_input_output(fname_in, fname_out)
+    global MP, BACKEND
+
+    resume = can_resume(fname_in)
+    fin, fout = open_input_output(fname_in, fname_out, resume)
+    if fname_in.lower().endswith(".cue"):
+        # Compress the BIN's user data directly instead of extracting an ISO
+        fin.close()
+        try:
+            fin = CueReader(fname_in)
+        except (IOError, ValueError) as e:
+            print("Can't read CUE sheet %s: %s" % (fname_in, e))
+            sys.exit(-1)
+    if not fin.seekable() or not fout.seekable():
+        # The header needs the image size and the index is written last
+        print("Compressing needs a regular input and output file")
+        sys.exit(-1)
     fin.seek(0, os.SEEK_END)
     total_bytes = fin.tell()
     fin.seek(0)
@@ -226,112 +1457,153 @@ def compress_zso(fname_in, fname_out, level, bsize):
 
     # We have to use alignment on any ZSO files which > 2GB, for MSB bit of index as the plain indicator
     # If we don't then the index can be larger than 2GB, which its plain indicator was improperly set
-    align = total_bytes // 2 ** 31
+    align = max(align, total_bytes // 2 ** 31)
 
     header = generate_zso_header(
         magic, header_size, total_bytes, block_size, ver, align)
-    fout.write(header)
 
     total_block = total_bytes // block_size
-    index_buf = [0 for i in range(total_block + 1)]
-
-    fout.write(b"\x00\x00\x00\x00" * len(index_buf))
-    show_comp_info(fname_in, fname_out, total_bytes, block_size, ver, align, level)
-
-    write_pos = fout.tell()
-    percent_period = total_block/100
-    percent_cnt = 0
-
-    if MP:
-        pool = Pool()
-
-    block = 0
-    while block < total_block:
-        if MP:
-            percent_cnt += min(total_block - block, MP_NR)
-        else:
-            percent_cnt += 1
-
-        if percent_cnt >= percent_period and percent_period != 0:
-            percent_cnt = 0
+    index_buf = array('I', bytes(4 * (total_block + 1)))
+
+    journal, block = None, 0
+    if resume:
+        # A CUE sheet's BIN is what has to stay unchanged
+        fname_src = fin.name if isinstance(fin, CueReader) else fname_in
+        journal, block = open_journal(fname_src, fname_out, fout, {
+            "mode": "compress", "block_size": block_size, "align": align,
+            "level": level, "target": TARGET_RATE, "threshold": COMPRESS_THREHOLD,
+            "adaptive": ADAPTIVE, "table": SECTOR_TABLE, "padding": DEFAULT_PADDING.decode()})
+
+    if block:
+        # The level -T picked for the interrupted run has to be kept
+        level = journal.record.get("level", level)
+    elif TARGET_RATE:
+        level, rate = pick_level(fin, total_block, block_size, level,
+                                 TARGET_RATE, JOBS if MP else 1)
+        print("auto level      %d (%d MB/s estimated for %d MB/s target)" % (
+            level, rate, TARGET_RATE))
+
+    levels = None
+    if SECTOR_TABLE:
+        try:
+            levels = load_sector_table(SECTOR_TABLE, total_block, block_size, level)
+        except (IOError, ValueError) as e:
+            print("Can't load sector table %s: %s" % (SECTOR_TABLE, e))
+            sys.exit(-1)
 
-            if block == 0:
-                print("compress %3d%% avarage rate %3d%%\r" % (
-                    block / percent_period, 0), file=sys.stderr, end='\r')
-            else:
-                print("compress %3d%% avarage rate %3d%%\r" % (
-                    block / percent_period, 100*write_pos/(block*block_size)), file=sys.stderr, end='\r')
-
-        if MP:
-            iso_data = [(fin.read(block_size), level)
-                        for i in range(min(total_block - block, MP_NR))]
-            zso_data_all = pool.map_async(
-                lz4_compress_mp, iso_data).get(9999999)
-
-            for i, zso_data in enumerate(zso_data_all):
-                write_pos = set_align(fout, write_pos, align)
-                index_buf[block] = write_pos >> align
-
-                if 100 * len(zso_data) / len(iso_data[i][0]) >= min(COMPRESS_THREHOLD, 100):
-                    zso_data = iso_data[i][0]
-                    index_buf[block] |= 0x80000000  # Mark as plain
-                elif index_buf[block] & 0x80000000:
-                    print(
-                        "Align error, you have to increase align by 1 or OPL won't be able to read offset above 2 ** 31 bytes")
-                    sys.exit(1)
-
-                fout.write(zso_data)
-                write_pos += len(zso_data)
-                block += 1
-        else:
-            iso_data = fin.read(block_size)
+    # Zero padding is common on DVD images, every all-zero block gets the
+    # same payload and skips the codec
+    zero_payload = lz4_compress(bytes(block_size), level)
+    opts = (block_size, level, min(COMPRESS_THREHOLD, 100), zero_payload, ADAPTIVE)
+    stats = {"zero_blocks": 0, "plain_regions": []}
+
+    auto = None
+    if MP and BACKEND == "auto":
+        BACKEND, serial = pick_backend((total_block - block) * block_size,
+                                       *calibrate_compress(fin, total_block, block_size, opts),
+                                       "pipe" if isinstance(fin, CueReader) or fname_in == "-" else "shm")
+        MP = BACKEND != "serial"
+        auto = "auto backend    %s (%.1fs estimated serially)" % (BACKEND, serial)
+
+    if block:
+        index_buf[:block] = array('I', journal.index)
+        write_pos = journal.write_pos
+        fin.seek(block * block_size)
+    else:
+        fout.write(header)
+        fout.write(b"\x00\x00\x00\x00" * len(index_buf))
+        write_pos = fout.tell()
 
+    show_comp_info(fname_in, fname_out, total_bytes, block_size, ver, align, level)
+    if isinstance(fin, CueReader):
+        print("cue track       %s from '%s', %d sectors" % (fin.mode, fin.name, fin.sectors))
+    if levels:
+        print("sector table    %s (%d blocks plain, %d below level %d)" % (
+            SECTOR_TABLE, levels.count(0),
+            sum(1 for i in levels if 0 < i < level), level))
+    if auto:
+        print(auto)
+
+    # Map a regular input file so the codec works on it in place, pages
+    # are faulted in by whoever compresses them instead of copied by read()
+    mm = None
+    if isinstance(fin, io.BufferedReader) and block < total_block:
+        try:
+            mm = map_input(fin)
+        except (OSError, ValueError):
+            pass
+    view = memoryview(mm) if mm is not None else None
+    # Worker processes map the input again by name, which stdin doesn't
+    # have, they get it from the reader thread instead. Threads share `mm`.
+    shared = mm if fname_in != "-" or BACKEND == "thread" else None
+
+    progress = Progress("compress", total_block, block_size, block)
+    if MP and BACKEND == "shm" and shared is not None:
+        write_pos = compress_zso_shm(fname_in, shared, fout, block, total_block, align, index_buf,
+                                     write_pos, levels, opts, stats, journal, progress)
+    elif MP:
+        write_pos = compress_zso_mp(fin, fout, block, total_block, align, index_buf, write_pos,
+                                    levels, opts, stats, journal, progress, fname_in, shared)
+    else:
+        while block < total_block:
+            nr = min(total_block - block, MP_NR)
             try:
-                zso_data = lz4_compress(iso_data, level)
+                batch_levels = levels[block:block + nr].tobytes() if levels else None
+                if mm is not None:
+                    iso_data = view[block * block_size:(block + nr) * block_size]
+                    with progress.stage("codec"):
+                        result = lz4_compress_range(mm, block * block_size, (block + nr) * block_size,
+                                                    batch_levels, *opts)
+                else:
+                    with progress.stage("read"):
+                        iso_data = fin.read(nr * block_size)
+                    with progress.stage("codec"):
+                        result = lz4_compress_mp((iso_data, batch_levels) + opts)
             except Exception as e:
                 print("%d block: %s" % (block, e))
                 sys.exit(-1)
 
-            write_pos = set_align(fout, write_pos, align)
-            index_buf[block] = write_pos >> align
-
-            if 100 * len(zso_data) / len(iso_data) >= COMPRESS_THREHOLD:
-                zso_data = iso_data
-                index_buf[block] |= 0x80000000  # Mark as plain
-            elif index_buf[block] & 0x80000000:
-                print(
-                    "Align error, you have to increase align by 1 or CFW won't be able to read offset above 2 ** 31 bytes")
-                sys.exit(1)
-
-            fout.write(zso_data)
-            write_pos += len(zso_data)
-            block += 1
+            with progress.stage("write"):
+                write_pos = write_zso_batch(fout, write_pos, index_buf, block, iso_data, result,
+                                            block_size, align, zero_payload, stats)
+            block += nr
+            progress.update(block, block * block_size, write_pos)
+            if journal and journal.due(block):
+                journal.checkpoint(fout, block, write_pos, index_buf, level=level)
 
     # Last position (total size)
-    index_buf[block] = write_pos >> align
+    index_buf[total_block] = write_pos >> align
 
     # Update index block
     fout.seek(len(header))
-    for i in index_buf:
-        idx = pack('I', i)
-        fout.write(idx)
+    if sys.byteorder == 'big':
+        index_buf.byteswap()
+    fout.write(index_buf.tobytes())
 
     print("ziso compress completed , total size = %8d bytes , rate %d%%" %
           (write_pos, (write_pos*100/total_bytes)))
+    show_comp_summary(stats, total_block, block_size, level)
 
+    if mm is not None:
+        iso_data = None
+        view.release()
+        mm.close()
     fin.close()
     fout.close()
+    if journal:
+        journal.remove()
 
 
 def parse_args():
-    global MP, COMPRESS_THREHOLD, DEFAULT_PADDING, DEFAULT_ALIGN
+    global MP, MP_WINDOW, JOBS, COMPRESS_THREHOLD, DEFAULT_PADDING, DEFAULT_ALIGN
+    global ADAPTIVE, TARGET_RATE, SECTOR_TABLE, JOURNAL, BACKEND
 
     if len(sys.argv) < 2:
         usage()
         sys.exit(-1)
 
     try:
-        optlist, args = gnu_getopt(sys.argv, "c:b:mt:a:p:h")
+        optlist, args = gnu_getopt(sys.argv, "c:b:mj:w:B:t:AT:s:a:p:rh", PROGRESS_OPTIONS)
     except GetoptError as err:
         print(str(err))
         usage()
@@ -347,12 +1619,30 @@ def parse_args():
             bsize = int(a)
         elif o == '-m':
             MP = True
+        elif o == '-j':
+            MP = True
+            JOBS = max(int(a), 1)
+        elif o == '-w':
+            MP_WINDOW = max(int(a), 1)
+        elif o == '-B':
+            MP = True
+            BACKEND = a
         elif o == '-t':
             COMPRESS_THREHOLD = min(int(a), 100)
+        elif o == '-A':
+            ADAPTIVE = True
+        elif o == '-T':
+            TARGET_RATE = max(int(a), 1)
+        elif o == '-s':
+            SECTOR_TABLE = a
         elif o == '-a':
             DEFAULT_ALIGN = int(a)
         elif o == '-p':
             DEFAULT_PADDING = bytes(a[0], encoding='utf8')
+        elif o == '-r':
+            JOURNAL = True
+        elif o.startswith('--progress'):
+            parse_progress_option(o, a)
         elif o == '-h':
             usage()
             sys.exit(0)
@@ -363,6 +1653,13 @@ def parse_args():
         print("You have to specify input/output filename: %s", err)
         sys.exit(-1)
 
+    if JOBS is None:
+        JOBS = cpu_count()
+
+    if BACKEND not in ("pipe", "shm", "thread", "auto"):
+        print("Unknown backend %s, use pipe, shm, thread or auto" % (BACKEND))
+        sys.exit(-1)
+
     if bsize%2048 != 0:
         print("Error, invalid block size. Must be multiple of 2048.")
         sys.exit(-1)
@@ -370,43 +1667,881 @@ def parse_args():
     return level, bsize, fname_in, fname_out
 
 
-def load_sector_table(sector_table_fn, total_block, default_level=9):
-    # In future we will support NC
-    sectors = [default_level for i in range(total_block)]
+def load_sector_table(sector_table_fn, total_block, block_size=DEFAULT_BLOCK_SIZE, default_level=9):
+    # Lines are `sector:level` or `start-end:level` (end excluded) in 2048-byte
+    # sectors, level 0 stores the blocks plain. A block covered by several
+    # entries gets the lowest (fastest to decode) level.
+    sectors = array('b', [-1]) * total_block
+    sectors_per_block = block_size // DEFAULT_BLOCK_SIZE
 
     with open(sector_table_fn) as f:
         for line in f:
-            line = line.strip()
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
             a = line.split(":")
 
             if len(a) < 2:
                 raise ValueError("Invalid line founded: %s" % (line))
 
-            if -1 == a[0].find("-"):
-                try:
-                    sector, level = int(a[0]), int(a[1])
-                except ValueError:
-                    raise ValueError("Invalid line founded: %s" % (line))
-                if level < 1 or level > 9:
-                    raise ValueError("Invalid line founded: %s" % (line))
-                sectors[sector] = level
-            else:
-                b = a[0].split("-")
-                try:
+            try:
+                if -1 == a[0].find("-"):
+                    start, level = int(a[0]), int(a[1])
+                    end = start + 1
+                else:
+                    b = a[0].split("-")
                     start, end, level = int(b[0]), int(b[1]), int(a[1])
-                except ValueError:
-                    raise ValueError("Invalid line founded: %s" % (line))
-                i = start
-                while i < end:
-                    sectors[i] = level
-                    i += 1
+            except ValueError:
+                raise ValueError("Invalid line founded: %s" % (line))
+            if level < 0 or level > 12 or start < 0 or end <= start:
+                raise ValueError("Invalid line founded: %s" % (line))
+            if end > total_block * sectors_per_block:
+                raise ValueError("Sector out of image range: %s" % (line))
+
+            for block in range(start // sectors_per_block, (end - 1) // sectors_per_block + 1):
+                if sectors[block] == -1 or level < sectors[block]:
+                    sectors[block] = level
+
+    for block in range(total_block):
+        if sectors[block] == -1:
+            sectors[block] = default_level
 
     return sectors
 
 
+def profile_sectors(argv):
+    # Turn a list of LBAs read during boot into a table for -s: hot sectors
+    # get a fast-decoding level, everything else keeps the -c level
+    try:
+        optlist, args = gnu_getopt(argv, "l:g:h")
+    except GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(-1)
+
+    hot_level, gap = 1, PROFILE_GAP
+    for o, a in optlist:
+        if o == '-l':
+            hot_level = int(a)
+        elif o == '-g':
+            gap = max(int(a), 0)
+        elif o == '-h':
+            usage()
+            sys.exit(0)
+
+    if len(args) not in (1, 2) or hot_level < 0 or hot_level > 12:
+        print("You have to specify the LBA list and a level between 0 and 12")
+        sys.exit(-1)
+
+    # Accept `lba`, `lba count` or `start-end` per line
+    ranges = []
+    with open(args[0]) as f:
+        for line in f:
+            a = line.split("#")[0].replace("-", " ").split()
+            if not a:
+                continue
+            try:
+                start = int(a[0], 0)
+                end = int(a[1], 0) if "-" in line.split("#")[0] else start + (
+                    int(a[1], 0) if len(a) > 1 else 1)
+            except ValueError:
+                print("Invalid line founded: %s" % (line.strip()))
+                sys.exit(-1)
+            ranges.append((start, max(end, start + 1)))
+
+    # Merge ranges closer than `gap` sectors
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    table = "".join("%d-%d:%d\n" % (start, end, hot_level) for start, end in merged)
+    if len(args) == 2:
+        with open(args[1], "w") as f:
+            f.write(table)
+        print("%d hot ranges, %d sectors written to %s" % (
+            len(merged), sum(end - start for start, end in merged), args[1]))
+    else:
+        sys.stdout.write(table)
+
+
+class Crc32:
+    # zlib.crc32 behind the hashlib interface used by verify
+    name = "crc32"
+
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+
+    def hexdigest(self):
+        return "%08x" % (self.crc)
+
+
+def check_zso_index(index_buf, total_block, block_size, align, file_size):
+    # Offsets must start after the index, never go backwards, leave room
+    # for plain blocks and end inside the file
+    problems = []
+    prev = 0x18 + 4 * (total_block + 1)
+    for block in range(total_block + 1):
+        index = index_buf[block]
+        pos = (index & 0x7fffffff) << align
+        if pos < prev:
+            problems.append("%d block: 0x%08X before previous block at 0x%08X" % (
+                block, pos, prev))
+        elif block and index_buf[block - 1] & 0x80000000 and pos - prev < block_size:
+            problems.append("%d block: 0x%08X plain block only %d bytes" % (
+                block - 1, prev, pos - prev))
+        prev = max(prev, pos)
+
+    if prev > file_size:
+        problems.append("index ends at 0x%08X past the end of the file (%d bytes)" % (
+            prev, file_size))
+    return problems
+
+
+def init_verify_mp(fname_in, fname_src, index_buf, block_size, total_block, align):
+    init_decompress_mp(fname_in, index_buf, block_size, total_block, align)
+    MP_ZSO.src = open(fname_src, "rb") if fname_src else None
+
+
+def verify_zso_run(task):
+    # Decode a range in memory, return what the hashes need along with the
+    # blocks that failed to decode or differ from the source image
+    start, end, keep = task
+    fin, index_buf, block_size, total_block, align = MP_ZSO.run
+    errors = []
+    try:
+        dec_data = decompress_zso_run(fin, index_buf, start, end, block_size, total_block, align)
+    except ValueError:
+        # Go block by block to report every bad one, hash them as zeros
+        blocks = []
+        for block in range(start, end):
+            try:
+                blocks.append(decompress_zso_run(
+                    fin, index_buf, block, block + 1, block_size, total_block, align))
+            except ValueError as e:
+                errors.append(str(e))
+                blocks.append(bytes(block_size))
+        dec_data = b"".join(blocks)
+
+    diffs = []
+    if MP_ZSO.src:
+        src_data = seek_and_read(MP_ZSO.src, start * block_size, len(dec_data))
+        if src_data != dec_data:
+            for block in range(start, end):
+                pos = (block - start) * block_size
+                if src_data[pos:pos + block_size] != dec_data[pos:pos + block_size]:
+                    diffs.append(block)
+
+    return end, dec_data if keep else b"", errors, diffs
+
+
+def hash_stream(queue, hashes):
+    # One thread per hash, hashlib and zlib release the GIL on large buffers
+    while True:
+        data = queue.get()
+        if data is None:
+            break
+        for h in hashes:
+            h.update(data)
+
+
+def verify_zso(argv):
+    try:
+        optlist, args = gnu_getopt(argv, "j:w:H:h", PROGRESS_OPTIONS)
+    except GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(-1)
+
+    jobs, window, names = cpu_count(), MP_WINDOW, VERIFY_HASHES
+    for o, a in optlist:
+        if o == '-j':
+            jobs = max(int(a), 1)
+        elif o == '-w':
+            window = max(int(a), 1)
+        elif o == '-H':
+            names = [] if a == "none" else a.lower().split(",")
+        elif o.startswith('--progress'):
+            parse_progress_option(o, a)
+        elif o == '-h':
+            usage()
+            sys.exit(0)
+
+    if len(args) not in (1, 2):
+        print("You have to specify the ZSO file and optionally its source ISO")
+        sys.exit(-1)
+    fname_in = args[0]
+    fname_src = args[1] if len(args) == 2 else None
+
+    hashes = []
+    for name in names:
+        try:
+            hashes.append(Crc32() if name == "crc32" else hashlib.new(name))
+        except ValueError:
+            print("Unknown hash %s" % (name))
+            sys.exit(-1)
+
+    try:
+        with open(fname_in, "rb") as fin:
+            header = check_zso_header(fin)
+            if header is None:
+                print("ziso file format error")
+                sys.exit(-1)
+            magic, header_size, total_bytes, block_size, ver, align = header
+            total_block = total_bytes // block_size
+            index_buf = read_zso_index(fin, total_block)
+            file_size = os.fstat(fin.fileno()).st_size
+    except IOError:
+        print("Can't open %s" % (fname_in))
+        sys.exit(-1)
+
+    print("Verify '%s'%s" % (fname_in, " against '%s'" % (fname_src) if fname_src else ""))
+    if len(index_buf) != total_block + 1:
+        print("Index truncated, %d of %d entries" % (len(index_buf), total_block + 1))
+        sys.exit(-1)
+    problems = check_zso_index(index_buf, total_block, block_size, align, file_size)
+    if problems:
+        for problem in problems[:VERIFY_REPORT]:
+            print(problem)
+        print("Index is broken (%d problems), blocks not decoded" % (len(problems)))
+        sys.exit(-1)
+
+    if fname_src:
+        try:
+            src_size = os.path.getsize(fname_src)
+        except OSError:
+            print("Can't open %s" % (fname_src))
+            sys.exit(-1)
+        if src_size != total_bytes:
+            problems.append("source is %d bytes, ZSO holds %d bytes" % (src_size, total_bytes))
+
+    # Every hash gets its own thread so they run alongside each other and
+    # the workers
+    queues = [Queue(4) for h in hashes]
+    threads = [Thread(target=hash_stream, args=(queue, [h])) for queue, h in zip(queues, hashes)]
+    for thread in threads:
+        thread.start()
+
+    errors, diffs = [], []
+    block = 0
+    progress = Progress("verify", total_block, block_size)
+    start_time = perf_counter()
+
+    def collect(end, dec_data, run_errors, run_diffs):
+        nonlocal block
+        for queue in queues:
+            queue.put(dec_data)
+        errors.extend(run_errors)
+        diffs.extend(run_diffs)
+        block = end
+        progress.update(block, (index_buf[block] & 0x7fffffff) << align, block * block_size)
+
+    tasks = ((start, min(start + MP_NR, total_block), bool(hashes))
+             for start in range(0, total_block, MP_NR))
+    init_args = (fname_in, fname_src, index_buf, block_size, total_block, align)
+    try:
+        if jobs > 1:
+            window = window or 4 * jobs
+            pending = deque()
+            with Pool(jobs, init_verify_mp, init_args) as pool:
+                for task in tasks:
+                    pending.append(pool.apply_async(verify_zso_run, (task,)))
+                    if len(pending) >= window:
+                        with progress.stage("codec"):
+                            result = pending.popleft().get()
+                        collect(*result)
+                while pending:
+                    with progress.stage("codec"):
+                        result = pending.popleft().get()
+                    collect(*result)
+        else:
+            init_verify_mp(*init_args)
+            for task in tasks:
+                with progress.stage("codec"):
+                    result = verify_zso_run(task)
+                collect(*result)
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+    elapsed = perf_counter() - start_time
+
+    print("%d blocks, %d bytes verified in %.1fs (%.1f MB/s)" % (
+        total_block, total_bytes, elapsed, total_bytes / max(elapsed, 1e-9) / 1024 ** 2))
+    for h in hashes:
+        print("%-7s %s" % (h.name, h.hexdigest()))
+
+    problems += errors + ["%d block differs from the source" % (block) for block in diffs]
+    if problems:
+        for problem in problems[:VERIFY_REPORT]:
+            print(problem)
+        if len(problems) > VERIFY_REPORT:
+            print("... %d more" % (len(problems) - VERIFY_REPORT))
+        print("ziso verify failed, %d bad blocks, %d blocks differ" % (len(errors), len(diffs)))
+        sys.exit(-1)
+    print("ziso verify completed")
+
+
+def init_batch_mp():
+    MP_ZSO.images = OrderedDict()
+
+
+def decompress_batch_run(task):
+    # Like decompress_zso_mp_run for any image of a batch, every worker keeps
+    # the last BATCH_OPEN images it touched open with their index loaded
+    fname, start, end = task
+    images = MP_ZSO.images
+    if fname in images:
+        images.move_to_end(fname)
+    else:
+        fin = open(fname, "rb")
+        magic, header_size, total_bytes, block_size, ver, align = read_zso_header(fin)
+        total_block = total_bytes // block_size
+        images[fname] = (fin, read_zso_index(fin, total_block), block_size, total_block, align)
+        if len(images) > BATCH_OPEN:
+            images.popitem(last=False)[1][0].close()
+    fin, index_buf, block_size, total_block, align = images[fname]
+    return decompress_zso_run(fin, index_buf, start, end, block_size, total_block, align)
+
+
+def find_zso(paths):
+    # Files are taken as given, directories are searched for .zso files
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(".zso"):
+                    yield os.path.join(root, name)
+
+
+def batch_zso(argv):
+    global BACKEND, JOURNAL
+
+    try:
+        optlist, args = gnu_getopt(argv, "j:B:M:o:rxh", PROGRESS_OPTIONS)
+    except GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(-1)
+
+    jobs, inflight_max, out_dir, remove = cpu_count(), BATCH_INFLIGHT, None, False
+    for o, a in optlist:
+        if o == '-j':
+            jobs = max(int(a), 1)
+        elif o == '-B':
+            BACKEND = a
+        elif o == '-M':
+            inflight_max = max(int(a), 1) * 1024 ** 2
+        elif o == '-o':
+            out_dir = a
+        elif o == '-r':
+            JOURNAL = True
+        elif o == '-x':
+            remove = True
+        elif o.startswith('--progress'):
+            parse_progress_option(o, a)
+        elif o == '-h':
+            usage()
+            sys.exit(0)
+
+    if not args:
+        print("You have to specify ZSO files or directories")
+        sys.exit(-1)
+    if BACKEND not in ("pipe", "thread"):
+        # shm only has a compression side
+        print("Unknown backend %s, use pipe or thread" % (BACKEND))
+        sys.exit(-1)
+
+    images = []
+    failed = 0
+    for fname in find_zso(args):
+        try:
+            with open(fname, "rb") as fin:
+                header = check_zso_header(fin)
+        except IOError:
+            header = None
+        if header is None:
+            print("Skipping %s, not a ZSO file" % (fname))
+            failed += 1
+            continue
+        magic, header_size, total_bytes, block_size, ver, align = header
+        fname_out = os.path.splitext(fname)[0] + ".iso"
+        if out_dir:
+            fname_out = os.path.join(out_dir, os.path.basename(fname_out))
+        images.append({"fname": fname, "out": fname_out, "total_bytes": total_bytes,
+                       "block_size": block_size, "total_block": total_bytes // block_size,
+                       "block": 0, "fout": None, "journal": None, "error": False})
+
+    # The largest images go first so the small ones fill the pool at the end
+    images.sort(key=lambda image: image["total_bytes"], reverse=True)
+    total_bytes = sum(image["total_bytes"] for image in images)
+    print("Batch of %d images, %d MB, %d %s workers" % (
+        len(images), total_bytes // 1024 ** 2, jobs, BACKEND))
+
+    opened = []
+    pending = deque()
+    inflight = done_bytes = converted = 0
+    progress = Progress("batch", total_bytes, 1)
+
+    def begin(image):
+        # Failing to start an image only fails that image, runs already
+        # queued for the others are still written
+        # Every image still being written may grow to its full size
+        reserved = sum(i["total_bytes"] - i["block"] * i["block_size"] for i in opened)
+        try:
+            free = shutil.disk_usage(os.path.dirname(os.path.abspath(image["out"]))).free
+        except OSError as e:
+            print("Can't create %s: %s" % (image["out"], e))
+            return False
+        if free - reserved < image["total_bytes"]:
+            print("Not enough free space for %s, %d MB needed, %d MB left" % (
+                image["out"], image["total_bytes"] // 1024 ** 2, max(free - reserved, 0) // 1024 ** 2))
+            return False
+
+        print("Converting: %s -> %s" % (image["fname"], image["out"]))
+        try:
+            image["fout"] = open_output(image["out"], JOURNAL)
+            image["sparse"] = is_sparse(image["fout"])
+            if JOURNAL:
+                image["journal"], image["block"] = open_journal(
+                    image["fname"], image["out"], image["fout"],
+                    {"mode": "decompress", "block_size": image["block_size"]})
+        except OSError as e:
+            print("Can't create %s: %s" % (image["out"], e))
+            if image["fout"]:
+                image["fout"].close()
+            return False
+        opened.append(image)
+        return True
+
+    def finish(image, error=None):
+        nonlocal converted, failed
+        fout, journal = image["fout"], image["journal"]
+        opened.remove(image)
+        if error:
+            print("Failed to uncompress %s: %s" % (image["fname"], error))
+            image["error"] = True
+            failed += 1
+            fout.close()
+            # Keep a partial output its journal can resume
+            if not (journal and os.path.exists(journal.fname)):
+                os.remove(image["out"])
+            return
+
+        if image["sparse"]:
+            fout.truncate(fout.tell())
+        fout.close()
+        if journal:
+            journal.remove()
+        if remove:
+            os.remove(image["fname"])
+        converted += 1
+
+    def write_run():
+        nonlocal inflight, done_bytes
+        image, start, end, result = pending.popleft()
+        block_size = image["block_size"]
+        inflight -= (end - start) * block_size
+        done_bytes += (end - start) * block_size
+        progress.update(done_bytes, None, done_bytes)
+        if image["error"]:
+            return
+        try:
+            with progress.stage("codec"):
+                dec_data = result()
+            with progress.stage("write"):
+                write_sparse(image["fout"], dec_data, block_size, image["sparse"])
+        except (ValueError, IOError) as e:
+            finish(image, e)
+            return
+        image["block"] = end
+        journal = image["journal"]
+        if journal and journal.due(end):
+            journal.checkpoint(image["fout"], end, end * block_size)
+        if end == image["total_block"]:
+            finish(image)
+
+    pool, submit = start_pool(jobs, init_batch_mp)
+    with pool:
+        for image in images:
+            if not begin(image):
+                failed += 1
+                done_bytes += image["total_bytes"]
+                continue
+            block_size, total_block = image["block_size"], image["total_block"]
+            done_bytes += image["block"] * block_size
+            if image["block"] == total_block:
+                finish(image)
+            for start in range(image["block"], total_block, MP_NR):
+                end = min(start + MP_NR, total_block)
+                # Bound the decoded data waiting in the pool, whatever the image
+                while pending and inflight + (end - start) * block_size > inflight_max:
+                    write_run()
+                if image["error"]:
+                    break
+                pending.append((image, start, end, submit(
+                    decompress_batch_run, (image["fname"], start, end))))
+                inflight += (end - start) * block_size
+
+        while pending:
+            write_run()
+
+    print("ziso batch completed, %d converted, %d failed" % (converted, failed))
+    if failed:
+        sys.exit(-1)
+
+
+def decode_cost(block_size):
+    # Seconds the codec takes for one compressed block on this machine,
+    # timed on a synthetic sector rather than on the file
+    global DECODE_COST
+    if DECODE_COST is None:
+        plain = (b"SECTOR %08d " % (0) * (block_size // 16 + 1))[:block_size]
+        zso_data = lz4_compress(plain, 9)
+        start = perf_counter()
+        for i in range(256):
+            lz4_decompress(zso_data, block_size, 0)
+        DECODE_COST = (perf_counter() - start) / 256
+    return DECODE_COST
+
+
+def zso_stats(fname, regions=INFO_MAP):
+    # Everything info reports, from the header and the index alone
+    with open(fname, "rb") as fin:
+        header = check_zso_header(fin)
+        if header is None:
+            raise ValueError("ziso file format error")
+        magic, header_size, total_bytes, block_size, ver, align = header
+        total_block = total_bytes // block_size
+        index_buf = read_zso_index(fin, total_block)
+        file_size = os.fstat(fin.fileno()).st_size
+    if len(index_buf) != total_block + 1:
+        raise ValueError("index truncated")
+
+    # Only checks that cost nothing per block, verify walks the whole index
+    first = (index_buf[0] & 0x7fffffff) << align
+    last = (index_buf[total_block] & 0x7fffffff) << align
+    if first < 0x18 + 4 * (total_block + 1):
+        raise ValueError("index starts at 0x%08X inside the index" % (first))
+    if last < first:
+        raise ValueError("index ends at 0x%08X before it starts" % (last))
+    if last > file_size:
+        raise ValueError("index ends at 0x%08X past the end of the file (%d bytes)" % (
+            last, file_size))
+
+    # The plain flag is the top bit of each entry, count them on the high
+    # bytes of the index without a loop
+    high = 3 if sys.byteorder == 'little' else 0
+    flags = index_buf.tobytes()[high:4 * total_block:4]
+    plain_bytes = bytes(range(0x80, 0x100))
+
+    def offset(block):
+        return (index_buf[block] & 0x7fffffff) << align
+
+    def plain_count(start, end):
+        return (end - start) - len(flags[start:end].translate(None, plain_bytes))
+
+    plain = plain_count(0, total_block)
+    data_size = offset(total_block) - offset(0)
+    compressed = total_block - plain
+    compressed_size = data_size - plain * block_size
+
+    region = max(-(-total_block // regions), 1)
+    regions_map = []
+    for start in range(0, total_block, region):
+        end = min(start + region, total_block)
+        if plain_count(start, end) == end - start:
+            regions_map.append(None)
+        else:
+            regions_map.append(min(max(offset(end) - offset(start), 0) / ((end - start) * block_size), 1))
+
+    return {
+        "file": fname,
+        "total_bytes": total_bytes,
+        "block_size": block_size,
+        "total_blocks": total_block,
+        "align": align,
+        "zso_bytes": file_size,
+        "ratio": round(file_size / total_bytes, 4),
+        "plain_blocks": plain,
+        "compressed_blocks": compressed,
+        "compressed_ratio": round(compressed_size / (compressed * block_size), 4) if compressed else None,
+        # Every compressed block wastes half an alignment unit on average
+        "padding_bytes": compressed * ((1 << align) - 1) // 2,
+        "decode_seconds": round(compressed * decode_cost(block_size), 3),
+        "region_blocks": region,
+        "regions": [None if r is None else round(r, 3) for r in regions_map],
+        "keep_zso": file_size * 100 < total_bytes * INFO_KEEP,
+    }
+
+
+def show_zso_stats(stats):
+    print("'%s'" % (stats["file"]))
+    print("total size      %d bytes, %d blocks of %d bytes, align %d" % (
+        stats["total_bytes"], stats["total_blocks"], stats["block_size"], stats["align"]))
+    print("zso size        %d bytes, %d%% of the image" % (
+        stats["zso_bytes"], 100 * stats["ratio"]))
+    print("plain blocks    %d (%d%%), compressed %d at %s" % (
+        stats["plain_blocks"], 100 * stats["plain_blocks"] // stats["total_blocks"],
+        stats["compressed_blocks"], "%d%%" % (100 * stats["compressed_ratio"])
+        if stats["compressed_ratio"] is not None else "-"))
+    print("padding         ~%d bytes" % (stats["padding_bytes"]))
+    print("decode cost     ~%.2fs CPU for the codec, %d MB read" % (
+        stats["decode_seconds"], stats["zso_bytes"] // 1024 ** 2))
+    print("verdict         %s" % ("keep as ZSO" if stats["keep_zso"] else
+                                   "store as ISO, saves less than %d%%" % (100 - INFO_KEEP)))
+
+    # One character per region: tenths of the size it's stored at, # plain
+    print("map             %d blocks per character, 0-9 tenths stored, # plain" % (
+        stats["region_blocks"]))
+    chars = "".join("#" if r is None else str(min(int(r * 10), 9)) for r in stats["regions"])
+    for pos in range(0, len(chars), 64):
+        print("  %s" % (chars[pos:pos + 64]))
+
+    histogram = [0] * 11
+    for r in stats["regions"]:
+        histogram[10 if r is None else min(int(r * 10), 9)] += 1
+    for i, nr in enumerate(histogram):
+        if nr:
+            print("  %-12s %d regions" % ("plain" if i == 10 else "%d-%d%%" % (10 * i, 10 * i + 10), nr))
+
+
+def info_zso(argv):
+    try:
+        optlist, args = gnu_getopt(argv, "n:Jh")
+    except GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(-1)
+
+    regions, as_json = INFO_MAP, False
+    for o, a in optlist:
+        if o == '-n':
+            regions = max(int(a), 1)
+        elif o == '-J':
+            as_json = True
+        elif o == '-h':
+            usage()
+            sys.exit(0)
+
+    if not args:
+        print("You have to specify ZSO files or directories")
+        sys.exit(-1)
+
+    failed = 0
+    for fname in find_zso(args):
+        try:
+            stats = zso_stats(fname, regions)
+        except (IOError, ValueError) as e:
+            print("%s: %s" % (fname, e), file=sys.stderr)
+            failed += 1
+            continue
+        if as_json:
+            print(json.dumps(stats))
+        else:
+            show_zso_stats(stats)
+    if failed:
+        sys.exit(-1)
+
+
+class ZsoMount:
+    # FUSE operations exposing a directory tree with every .zso file shown as
+    # a read-only .iso decoded on demand. Other files are passed through.
+
+    def __init__(self, src_dir, readahead=MOUNT_READAHEAD):
+        self.src_dir = os.path.realpath(src_dir)
+        self.readahead = readahead
+        self.handles = {}
+        self.fh = count(1)
+        self.sizes = {}
+
+    def __call__(self, op, *args):
+        if not hasattr(self, op):
+            raise OSError(errno.ENOSYS, op)
+        return getattr(self, op)(*args)
+
+    def real_path(self, path):
+        # Returns the backing file and whether it is a ZSO shown as an ISO
+        real = os.path.join(self.src_dir, path.lstrip("/"))
+        if os.path.lexists(real):
+            return real, False
+        stem, ext = os.path.splitext(real)
+        if ext.lower() == ".iso":
+            for zso_ext in (".zso", ".ZSO"):
+                if os.path.isfile(stem + zso_ext):
+                    return stem + zso_ext, True
+        raise OSError(errno.ENOENT, path)
+
+    def iso_size(self, real, st):
+        key = (st.st_mtime_ns, st.st_size)
+        cached = self.sizes.get(real)
+        if cached is None or cached[0] != key:
+            with open(real, "rb") as fin:
+                header = check_zso_header(fin)
+            if header is None:
+                raise OSError(errno.EIO, real)
+            magic, header_size, total_bytes, block_size, ver, align = header
+            cached = (key, total_bytes // block_size * block_size)
+            self.sizes[real] = cached
+        return cached[1]
+
+    def getattr(self, path, fh=None):
+        real, zso = self.real_path(path)
+        st = os.lstat(real)
+        attr = dict((key, getattr(st, key)) for key in (
+            "st_atime", "st_ctime", "st_mtime", "st_gid", "st_uid", "st_nlink", "st_size"))
+        # Everything on the mount is read-only
+        attr["st_mode"] = st.st_mode & ~0o222
+        if zso:
+            attr["st_size"] = self.iso_size(real, st)
+        return attr
+
+    def readdir(self, path, fh):
+        real, zso = self.real_path(path)
+        names = os.listdir(real)
+        present = set(name.lower() for name in names)
+        entries = [".", ".."]
+        for name in names:
+            stem, ext = os.path.splitext(name)
+            if ext.lower() == ".zso" and os.path.isfile(os.path.join(real, name)):
+                if (stem + ".iso").lower() in present:
+                    continue  # an uncompressed copy already exists
+                name = stem + ".iso"
+            entries.append(name)
+        return entries
+
+    def statfs(self, path):
+        st = os.statvfs(self.src_dir)
+        return dict((key, getattr(st, key)) for key in (
+            "f_bavail", "f_bfree", "f_blocks", "f_bsize", "f_favail",
+            "f_ffree", "f_files", "f_flag", "f_frsize", "f_namemax"))
+
+    def access(self, path, mode):
+        self.real_path(path)
+        if mode & os.W_OK:
+            raise OSError(errno.EROFS, path)
+        return 0
+
+    def open(self, path, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise OSError(errno.EROFS, path)
+        real, zso = self.real_path(path)
+        try:
+            reader = ZsoReader(real, readahead=self.readahead) if zso else open(real, "rb")
+        except ValueError:
+            raise OSError(errno.EIO, path)
+        fh = next(self.fh)
+        # [reader, lock, offset the next sequential read starts at]
+        self.handles[fh] = [reader, Lock(), 0]
+        return fh
+
+    def read(self, path, size, offset, fh):
+        handle = self.handles[fh]
+        reader, lock, next_offset = handle
+        with lock:
+            if isinstance(reader, ZsoReader):
+                # Only decode ahead while the access pattern is sequential
+                reader.readahead = self.readahead if offset == next_offset else 1
+            try:
+                reader.seek(offset)
+                data = reader.read(size)
+            except ValueError:
+                raise OSError(errno.EIO, path)
+            handle[2] = offset + len(data)
+        return data
+
+    def release(self, path, fh):
+        handle = self.handles.pop(fh, None)
+        if handle:
+            handle[0].close()
+        return 0
+
+    def opendir(self, path):
+        self.real_path(path)
+        return 0
+
+    def releasedir(self, path, fh):
+        return 0
+
+    def flush(self, path, fh):
+        return 0
+
+    def init(self, path):
+        pass
+
+    def destroy(self, path):
+        for fh in list(self.handles):
+            self.release(None, fh)
+
+
+def mount_zso(argv):
+    try:
+        optlist, args = gnu_getopt(argv, "r:h")
+    except GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(-1)
+
+    readahead = MOUNT_READAHEAD
+    for o, a in optlist:
+        if o == '-r':
+            readahead = max(int(a), 1)
+        elif o == '-h':
+            usage()
+            sys.exit(0)
+
+    try:
+        src_dir, mountpoint = args
+    except ValueError:
+        print("You have to specify the source directory and the mount point")
+        sys.exit(-1)
+
+    try:
+        from fuse import FUSE
+    except ImportError:
+        print("Mounting requires fusepy, install it with: pip install fusepy")
+        sys.exit(-1)
+    except OSError as err:
+        # fusepy raises this when libfuse itself is missing
+        print("Mounting requires libfuse: %s" % (err))
+        sys.exit(-1)
+
+    print("Mounting '%s' on '%s' (read-only), press Ctrl+C or unmount to stop" % (
+        src_dir, mountpoint))
+    FUSE(ZsoMount(src_dir, readahead), mountpoint,
+         foreground=True, ro=True, fsname="ziso")
+
+
+COMMANDS = {
+    "batch": batch_zso,
+    "info": info_zso,
+    "mount": mount_zso,
+    "profile": profile_sectors,
+    "verify": verify_zso,
+}
+
+
 def main():
-    print("ziso-python %s by %s" % (__version__, __author__))
+    if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        # Commands may write their results to stdout
+        print("ziso-python %s by %s" % (__version__, __author__), file=sys.stderr)
+        COMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+
     level, bsize, fname_in, fname_out = parse_args()
+    if fname_out == "-":
+        # Keep stdout for the image, messages go to stderr
+        sys.stdout = sys.stderr
+    print("ziso-python %s by %s" % (__version__, __author__))
 
     if level == 0:
         decompress_zso(fname_in, fname_out)
@@ -414,11 +2549,13 @@ def main():
         compress_zso(fname_in, fname_out, level, bsize)
 
 
-PROFILE = False
+# ZISO_PROFILE=1 prints a cProfile of the run, any other value is the file
+# the stats are saved to (ziso_bench.py -p saves the same for its cases)
+PROFILE = os.environ.get("ZISO_PROFILE")
 
 if __name__ == "__main__":
     if PROFILE:
         import cProfile
-        cProfile.run("main()")
+        cProfile.run("main()", None if PROFILE == "1" else PROFILE)
     else:
         main()
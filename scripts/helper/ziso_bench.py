@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+"""
+ZSO codec benchmarks for ziso.py
+
+Usage: ziso_bench.py [-S name=mb,...] [-k kinds] [-n repeats] [-o report.json]
+                     [-b baseline.json] [-t percent] [-p profile] [-l] [-q]
+
+Builds synthetic images in a temporary directory and times compress_zso and
+decompress_zso on them. Every image kind (zero, text, random, fmv, mixed) is
+built at every size (a CD and a DVD sized image by default, scaled down so a
+run takes minutes, not hours). Starting from level 9, 2048 byte blocks,
+alignment 0 and serial mode, one setting at a time is swept:
+
+  level       1-12
+  block size  2048, 4096, 6144, 8192
+  alignment   0-6
+  mode        serial, -m with the pipe, shm and thread backends
+
+The results go to a JSON report. Given a baseline report from an earlier run,
+every case found in both is compared and the run fails when compression or
+decompression got slower by more than the tolerance. With -p the default case
+of the first image is run under cProfile as well, the same profile ziso.py
+writes when ZISO_PROFILE is set. With -l the align sweep also decodes in
+memory with the old trim-one-byte retry loop, whose cost grows with the
+padding while the current decoder stays flat.
+"""
+
+import sys
+import os
+import io
+import json
+import platform
+import random
+import tempfile
+import time
+from contextlib import redirect_stdout, redirect_stderr
+from getopt import gnu_getopt, GetoptError
+
+import lz4
+import lz4.block
+import ziso
+
+BLOCK_SIZE = 0x800
+LEVEL = 9
+SIZES = {"cd": 16, "dvd": 64}  # MB
+KINDS = ["zero", "text", "random", "fmv", "mixed"]
+TOLERANCE = 10  # percent slower than the baseline that counts as a regression
+
+SWEEPS = {
+    "level": range(1, 13),
+    "block_size": [2048, 4096, 6144, 8192],
+    "align": range(7),
+    "mode": ["serial", "pipe", "shm", "thread"],
+}
+DEFAULT_CASE = {"level": LEVEL, "block_size": BLOCK_SIZE, "align": 0, "mode": "serial"}
+
+
+def make_image(fname, size, kind="mixed"):
+    # Deterministic content, the same kind and size always give the same image
+    rnd = random.Random(0)
+    words = [bytes(rnd.choice(b"abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(2, 9)))
+             for _ in range(512)]
+    text = b" ".join(rnd.choice(words) for _ in range(256 * 1024))
+    acgt = bytes(b"ACGT"[i % 4] for i in range(256))
+
+    def sector(nr):
+        if kind == "zero":
+            return bytes(BLOCK_SIZE)
+        if kind == "text":
+            pos = rnd.randrange(len(text) - BLOCK_SIZE)
+            return text[pos:pos + BLOCK_SIZE]
+        if kind == "random":
+            return rnd.randbytes(BLOCK_SIZE)
+        if kind == "fmv":
+            # Pack headers over high entropy payload, now and then a run of
+            # stuffing bytes or a low entropy sector
+            if nr % 16 == 0:
+                return rnd.randbytes(BLOCK_SIZE).translate(acgt)
+            header = b"\x00\x00\x01\xba" + nr.to_bytes(4, "big") + bytes(8)
+            stuffing = b"\xff" * (rnd.randrange(64) * 16 if nr % 3 == 0 else 0)
+            return (header + stuffing + rnd.randbytes(BLOCK_SIZE))[:BLOCK_SIZE]
+        # Mix of zero padding, text-like, low entropy and random sectors
+        mix = nr % 4
+        if mix == 0:
+            return bytes(BLOCK_SIZE)
+        if mix == 1:
+            return ((b"SECTOR %08d " % nr) * 128)[:BLOCK_SIZE]
+        if mix == 2:
+            return rnd.randbytes(BLOCK_SIZE).translate(acgt)
+        return rnd.randbytes(BLOCK_SIZE)
+
+    with open(fname, "wb") as f:
+        for nr in range(size // BLOCK_SIZE):
+            f.write(sector(nr))
+
+
+def quiet():
+    null = open(os.devnull, "w")
+    return null, redirect_stdout(null), redirect_stderr(null)
+
+
+def set_mode(mode):
+    ziso.MP = mode != "serial"
+    ziso.BACKEND = "pipe" if mode == "serial" else mode
+    ziso.JOBS = os.cpu_count() or 1
+
+
+def compress(fname_in, fname_out, align, level=LEVEL, block_size=BLOCK_SIZE, mode="serial"):
+    ziso.DEFAULT_ALIGN = align
+    set_mode(mode)
+    null, out, err = quiet()
+    with null, out, err:
+        ziso.compress_zso(fname_in, fname_out, level, block_size)
+
+
+def decompress(fname_in, fname_out, mode="serial"):
+    set_mode(mode)
+    null, out, err = quiet()
+    with null, out, err:
+        ziso.decompress_zso(fname_in, fname_out)
+
+
+def legacy_lz4_decompress(compressed, block_size):
+    while True:
+        try:
+            return lz4.block.decompress(compressed, uncompressed_size=block_size)
+        except lz4.block.LZ4BlockError:
+            compressed = compressed[:-1]
+
+
+def bench_decode(fname, legacy=False):
+    # Decode from memory so only the codec path is measured
+    with open(fname, "rb") as f:
+        fin = io.BytesIO(f.read())
+    magic, header_size, total_bytes, block_size, ver, align = ziso.read_zso_header(fin)
+    total_block = total_bytes // block_size
+    index_buf = ziso.read_zso_index(fin, total_block)
+
+    saved = ziso.lz4_decompress
+    if legacy:
+        ziso.lz4_decompress = lambda data, size, padding=0: legacy_lz4_decompress(data, size)
+    try:
+        start = time.perf_counter()
+        for block in range(0, total_block, ziso.MP_NR):
+            ziso.decompress_zso_run(fin, index_buf, block, min(block + ziso.MP_NR, total_block),
+                                    block_size, total_block, align)
+        elapsed = time.perf_counter() - start
+    finally:
+        ziso.lz4_decompress = saved
+
+    return mbps(total_bytes, elapsed)
+
+
+def mbps(size, elapsed):
+    return round(size / max(elapsed, 1e-9) / 1024 ** 2, 1)
+
+
+def cases():
+    # The default case, then one setting at a time away from it
+    seen = set()
+    for name, values in SWEEPS.items():
+        for value in values:
+            case = dict(DEFAULT_CASE, **{name: value})
+            key = tuple(sorted(case.items()))
+            if key not in seen:
+                seen.add(key)
+                yield name, case
+
+
+def case_key(result):
+    return (result["image"], result["size_mb"], result["level"], result["block_size"],
+            result["align"], result["mode"])
+
+
+def run_case(tmp, fname_iso, case, repeats, legacy):
+    fname_zso = os.path.join(tmp, "bench.zso")
+    fname_out = os.path.join(tmp, "bench.out")
+    size = os.path.getsize(fname_iso)
+    best_comp = best_decomp = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        compress(fname_iso, fname_zso, case["align"], case["level"], case["block_size"], case["mode"])
+        elapsed = time.perf_counter() - start
+        best_comp = min(elapsed, best_comp or elapsed)
+
+        start = time.perf_counter()
+        decompress(fname_zso, fname_out, case["mode"])
+        elapsed = time.perf_counter() - start
+        best_decomp = min(elapsed, best_decomp or elapsed)
+
+    result = dict(case, zso_bytes=os.path.getsize(fname_zso),
+                  compress_mbps=mbps(size, best_comp), decompress_mbps=mbps(size, best_decomp))
+    if legacy:
+        result["decode_mbps"] = bench_decode(fname_zso)
+        result["legacy_decode_mbps"] = bench_decode(fname_zso, legacy=True)
+    return result
+
+
+def profile_case(tmp, fname_iso, fname_prof):
+    import cProfile
+    import pstats
+    fname_zso = os.path.join(tmp, "profile.zso")
+    profiler = cProfile.Profile()
+    profiler.runcall(compress, fname_iso, fname_zso, 0)
+    profiler.runcall(decompress, fname_zso, os.path.join(tmp, "profile.out"))
+    profiler.dump_stats(fname_prof)
+    pstats.Stats(fname_prof).sort_stats("cumulative").print_stats(15)
+
+
+def compare(results, baseline, tolerance):
+    # Returns the cases that got slower than the baseline allows
+    base = {case_key(result): result for result in baseline["results"]}
+    regressions = []
+    print("\n%-24s %-26s %9s %9s" % ("image", "case", "comp", "decomp"))
+    for result in results:
+        old = base.get(case_key(result))
+        if not old:
+            continue
+        deltas = []
+        for metric in ("compress_mbps", "decompress_mbps"):
+            delta = 100 * (result[metric] - old[metric]) / max(old[metric], 1e-9)
+            deltas.append(delta)
+            if delta < -tolerance:
+                regressions.append((result, metric, delta))
+        print("%-24s %-26s %+8.1f%% %+8.1f%%" % (
+            "%s %dMB" % (result["image"], result["size_mb"]),
+            "L%d b%d a%d %s" % (result["level"], result["block_size"],
+                                result["align"], result["mode"]),
+            deltas[0], deltas[1]))
+    return regressions
+
+
+def usage():
+    print(__doc__.strip())
+
+
+def main():
+    try:
+        optlist, args = gnu_getopt(sys.argv[1:], "S:k:n:o:b:t:p:lqh")
+    except GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(-1)
+
+    sizes, kinds, repeats, tolerance = dict(SIZES), list(KINDS), 1, TOLERANCE
+    fname_report = fname_baseline = fname_prof = None
+    legacy = False
+    for o, a in optlist:
+        if o == '-S':
+            sizes = {name: int(mb) for name, mb in (i.split("=") for i in a.split(","))}
+        elif o == '-k':
+            kinds = a.split(",")
+        elif o == '-n':
+            repeats = max(int(a), 1)
+        elif o == '-o':
+            fname_report = a
+        elif o == '-b':
+            fname_baseline = a
+        elif o == '-t':
+            tolerance = float(a)
+        elif o == '-p':
+            fname_prof = a
+        elif o == '-l':
+            legacy = True
+        elif o == '-q':
+            # Only the default case and the mode sweep
+            for name in ("level", "block_size", "align"):
+                SWEEPS[name] = [DEFAULT_CASE[name]]
+        elif o == '-h':
+            usage()
+            sys.exit(0)
+
+    if args:
+        # The old single argument form, a mixed image of that many MB
+        sizes, kinds = {"custom": int(args[0])}, ["mixed"]
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "lz4": lz4.library_version_string(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "repeats": repeats,
+        },
+        "results": [],
+    }
+
+    print("%-24s %-10s %-26s %10s %9s %9s" % (
+        "image", "sweep", "case", "zso size", "comp MB/s", "dec MB/s"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size_name, size_mb in sizes.items():
+            for kind in kinds:
+                fname_iso = os.path.join(tmp, "%s-%s.iso" % (kind, size_name))
+                make_image(fname_iso, size_mb * 1024 ** 2, kind)
+                if fname_prof:
+                    profile_case(tmp, fname_iso, fname_prof)
+                    fname_prof = None
+
+                for sweep, case in cases():
+                    result = run_case(tmp, fname_iso, case,
+                                      repeats, legacy and sweep == "align")
+                    result.update(image=kind, size_mb=size_mb, sweep=sweep)
+                    report["results"].append(result)
+                    print("%-24s %-10s %-26s %10d %9.1f %9.1f%s" % (
+                        "%s %dMB" % (kind, size_mb), sweep,
+                        "L%d b%d a%d %s" % (case["level"], case["block_size"],
+                                            case["align"], case["mode"]),
+                        result["zso_bytes"], result["compress_mbps"], result["decompress_mbps"],
+                        "  decode %.1f legacy %.1f" % (result["decode_mbps"], result["legacy_decode_mbps"])
+                        if "decode_mbps" in result else ""))
+                os.remove(fname_iso)
+
+    if fname_report:
+        with open(fname_report, "w") as f:
+            json.dump(report, f, indent=1)
+
+    if fname_baseline:
+        with open(fname_baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report["results"], baseline, tolerance)
+        if regressions:
+            print("\n%d regressions over %g%%:" % (len(regressions), tolerance))
+            for result, metric, delta in regressions:
+                print("  %s %dMB L%d b%d a%d %s %s %+.1f%%" % (
+                    result["image"], result["size_mb"], result["level"], result["block_size"],
+                    result["align"], result["mode"], metric, delta))
+            sys.exit(1)
+        print("\nNo regressions over %g%%" % (tolerance))
+
+
+if __name__ == "__main__":
+    main()